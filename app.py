@@ -1,31 +1,278 @@
-from flask import Flask, render_template, request
-import sqlite3
+from flask import Flask, Response, jsonify, render_template, request
 from datetime import datetime
+import json
+import threading
+
+import attendance_db
+import attendance_export
+from response_cache import ChangeMarker, ResponseCache, make_etag
 
 app = Flask(__name__)
 
+# Rows per page of the JSON API
+PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+# One connection per server thread, opened (and migrated) on its first request
+_local = threading.local()
+
+
+def get_conn():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = attendance_db.connect('attendance.db')
+    return conn
+
+
+cache = ResponseCache()
+# A burst of refreshes reads the change markers once, new attendance shows up within a second
+markers = ChangeMarker(lambda: attendance_db.change_markers(get_conn()), ttl=1.0)
+
+
+class BadRequest(ValueError):
+    pass
+
+
+@app.errorhandler(BadRequest)
+def bad_request(e):
+    return jsonify(error=str(e)), 400
+
+
+def date_arg(name, default=None):
+    value = request.args.get(name) or default
+    if value is None:
+        raise BadRequest("'%s' is required (YYYY-MM-DD)" % name)
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise BadRequest("'%s' must be a date YYYY-MM-DD, got '%s'" % (name, value))
+
+
+def limit_arg():
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        raise BadRequest("'limit' must be a number")
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def cached_json(live, generate):
+    """Response of `generate()` cached by path and query string, 304 if the client has it already
+
+    Pages that include today are valid until the next write to the database,
+    pages of closed days until one of them is changed after the fact.
+    """
+    key = (request.path, tuple(sorted(request.args.items(multi=True))))
+    changes, history_changes = markers.get()
+    validator = ("live", changes) if live else ("closed", history_changes)
+    etag = make_etag(key, validator)
+    if request.if_none_match.contains(etag):
+        cache.count_not_modified()
+        response = Response(status=304)
+    else:
+        body = cache.get(key, validator)
+        if body is not None:
+            response = Response(body, mimetype='application/json')
+            response.headers['X-Cache'] = 'HIT'
+        else:
+            response = Response(cache.fill(key, validator, generate()), mimetype='application/json')
+            response.headers['X-Cache'] = 'MISS'
+    response.set_etag(etag)
+    # Browsers keep the body but ask every time, unchanged pages cost a 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def stream_page(rows, key, limit, to_json):
+    """JSON {"rows": [...], "next": cursor or null} written row by row, the page is never held in memory
+
+    `next` is the key of the last row when the page is full, the client passes
+    it back as `after` to get the next page.
+    """
+    yield '{"rows": ['
+    count = 0
+    last = None
+    for row in rows:
+        yield (',' if count else '') + json.dumps(to_json(row))
+        count += 1
+        last = row
+    yield '], "next": %s}' % json.dumps(key(last) if count == limit else None)
+
+
+def attendance_json(row):
+    day, seconds, person_id, name, department, position = row
+    return {"date": attendance_db.day_string(day), "time": attendance_db.time_string(seconds),
+            "person_id": person_id, "name": name, "department": department, "position": position}
+
+
+def attendance_key(row):
+    return "%d:%d:%d" % row[:3]
+
+
+def range_args(person_id=None):
+    """'from' and 'to' of the request"""
+    if person_id is None:
+        start = date_arg('from')
+        end = date_arg('to', start)
+    else:
+        # The whole history by default
+        start = date_arg('from', '1970-01-01')
+        end = date_arg('to', datetime.now().strftime('%Y-%m-%d'))
+    if end < start:
+        raise BadRequest("'to' is before 'from'")
+    return start, end
+
+
+def attendance_page(person_id=None):
+    start, end = range_args(person_id)
+    after = request.args.get('after')
+    try:
+        after = attendance_db.parse_cursor(after) if after else None
+    except ValueError:
+        raise BadRequest("'after' must be the 'next' value of the previous page")
+    department = request.args.get('department')
+    position = request.args.get('position')
+    limit = limit_arg()
+
+    def generate():
+        # Runs while the response is written, after the view has returned
+        rows = attendance_db.iter_attendance(get_conn(), start, end, department, position, person_id, after, limit)
+        yield from stream_page(rows, attendance_key, limit, attendance_json)
+
+    return cached_json(end >= datetime.now().strftime('%Y-%m-%d'), generate)
+
+
 @app.route('/')
 def index():
-    return render_template('index.html', selected_date='', no_data=False)
+    return render_template('index.html', selected_date='', cache_stats=cache.stats())
+
 
 @app.route('/attendance', methods=['POST'])
 def attendance():
+    # The page loads the rows of the selected date from the API
     selected_date = request.form.get('selected_date')
-    selected_date_obj = datetime.strptime(selected_date, '%Y-%m-%d')
-    formatted_date = selected_date_obj.strftime('%Y-%m-%d')
+    selected_date = datetime.strptime(selected_date, '%Y-%m-%d').strftime('%Y-%m-%d')
+    return render_template('index.html', selected_date=selected_date, cache_stats=cache.stats())
+
+
+@app.route('/api/attendance')
+def api_attendance():
+    """Attendance of the days 'from' to 'to', optionally of one 'department' / 'position', page after 'after'"""
+    return attendance_page()
+
+
+@app.route('/api/people')
+def api_people():
+    """Registered people in id order, optionally of one 'department' / 'position'"""
+    try:
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        raise BadRequest("'after' must be the 'next' value of the previous page")
+    department = request.args.get('department')
+    position = request.args.get('position')
+    limit = limit_arg()
+
+    def generate():
+        rows = attendance_db.iter_people(get_conn(), department, position, after, limit)
+        yield from stream_page(rows, lambda row: row[0], limit,
+                               lambda row: dict(zip(("person_id", "name", "department", "position"), row)))
+
+    return cached_json(True, generate)
+
+
+@app.route('/api/people/<int:person_id>/attendance')
+def api_person_attendance(person_id):
+    """Attendance history of one person over 'from' to 'to'"""
+    return attendance_page(person_id)
+
+
+def month_arg(name, default=None):
+    value = request.args.get(name) or default
+    try:
+        month = datetime.strptime(value or '', '%Y-%m')
+    except ValueError:
+        raise BadRequest("'%s' must be a month YYYY-MM" % name)
+    return month.year * 100 + month.month
+
+
+def summary_json(key_name, key, present, first_seconds, last_seconds):
+    return {key_name: key, "present": present,
+            "first_arrival": attendance_db.time_string(first_seconds) if first_seconds is not None else None,
+            "last_arrival": attendance_db.time_string(last_seconds) if last_seconds is not None else None}
+
+
+@app.route('/api/summary/daily')
+def api_summary_daily():
+    """People present and first / last arrival of every day from 'from' to 'to'"""
+    start = date_arg('from')
+    end = date_arg('to', start)
+
+    def generate():
+        rows = attendance_db.daily_summaries(get_conn(), start, end)
+        yield json.dumps({"rows": [summary_json("date", attendance_db.day_string(day), *row)
+                                   for day, *row in rows]})
+
+    return cached_json(end >= datetime.now().strftime('%Y-%m-%d'), generate)
+
+
+@app.route('/api/summary/departments')
+def api_summary_departments():
+    """People present and first / last arrival per department on 'date', today by default"""
+    date = date_arg('date', datetime.now().strftime('%Y-%m-%d'))
+
+    def generate():
+        rows = get_conn().execute(attendance_db.DEPARTMENTS_OF_DAY, (attendance_db.day_number(date),))
+        yield json.dumps({"date": date, "rows": [summary_json("department", *row) for row in rows]})
+
+    return cached_json(date >= datetime.now().strftime('%Y-%m-%d'), generate)
+
+
+@app.route('/api/summary/monthly')
+def api_summary_monthly():
+    """Attendance count (person-days) and first / last arrival per month and department, 'from' to 'to' YYYY-MM"""
+    start = month_arg('from')
+    end = month_arg('to', request.args.get('from'))
+    department = request.args.get('department')
+
+    def generate():
+        rows = attendance_db.monthly_summaries(get_conn(), start, end, department)
+        yield json.dumps({"rows": [dict(summary_json("month", "%04d-%02d" % (month // 100, month % 100), *row),
+                                        department=row_department)
+                                   for month, row_department, *row in rows]})
+
+    return cached_json(end >= int(datetime.now().strftime('%Y%m')), generate)
+
+
+@app.route('/export/attendance.<export_format>')
+def export_attendance(export_format):
+    """All attendance of 'from' to 'to' as a CSV or Excel download, filtered like /api/attendance"""
+    if export_format not in attendance_export.EXPORT_FORMATS:
+        raise BadRequest("Unknown export format '%s'" % export_format)
+    try:
+        person_id = int(request.args['person_id']) if request.args.get('person_id') else None
+    except ValueError:
+        raise BadRequest("'person_id' must be a number")
+    start, end = range_args(person_id)
+    department = request.args.get('department')
+    position = request.args.get('position')
+
+    def generate():
+        rows = attendance_export.export_rows(get_conn(), start, end, department, position, person_id)
+        yield from attendance_export.EXPORT_FORMATS[export_format](rows)
 
-    conn = sqlite3.connect('attendance.db')
-    cursor = conn.cursor()
+    mimetype = ('text/csv' if export_format == 'csv'
+                else 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename="attendance_%s_%s.%s"' % (
+        start, end, export_format)
+    return response
 
-    cursor.execute("SELECT name, department, position, time FROM attendance WHERE date = ?", (formatted_date,))
-    attendance_data = cursor.fetchall()
 
-    conn.close()
+@app.route('/api/cache')
+def api_cache():
+    """Hit ratio and memory use of the response cache"""
+    return jsonify(cache.stats())
 
-    if not attendance_data:
-        return render_template('index.html', selected_date=selected_date, no_data=True)
-    
-    return render_template('index.html', selected_date=selected_date, attendance_data=attendance_data)
 
 if __name__ == '__main__':
     app.run(debug=True)
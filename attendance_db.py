@@ -0,0 +1,365 @@
+"""
+Attendance database schema for Face Recognition Attendance System
+Every connection goes through connect(), which turns on WAL journaling and
+migrates the file in place to the current schema version: people are stored
+once in `people`, attendance rows only hold the person id, the day as
+YYYYMMDD, the arrival as seconds since midnight and the department of the
+person at that time, with indexes for the lookups by day, department and
+person
+"""
+
+import argparse
+import datetime
+import logging
+import sqlite3
+
+PATH_DB = "attendance.db"
+
+# Rows of one day, and the number of people present, as shown by the dashboards
+ATTENDANCE_OF_DAY = ("SELECT p.name, a.department, p.position, "
+                     "printf('%02d:%02d:%02d', a.seconds / 3600, a.seconds / 60 % 60, a.seconds % 60) "
+                     "FROM attendance a JOIN people p ON p.id = a.person_id WHERE a.day = ? ORDER BY a.seconds")
+COUNT_OF_DAY = "SELECT COALESCE((SELECT present FROM daily_summary WHERE day = ?), 0)"
+DEPARTMENTS_OF_DAY = ("SELECT department, present, first_seconds, last_seconds FROM department_daily "
+                      "WHERE day = ? AND present > 0 ORDER BY department")
+NAMES_OF_DAY = "SELECT p.name FROM attendance a JOIN people p ON p.id = a.person_id WHERE a.day = ?"
+
+# Upsert of the person, then their attendance; the first mark of a day wins
+UPSERT_PERSON = ("INSERT INTO people (name, department, position) VALUES (?, ?, ?) "
+                 "ON CONFLICT (name) DO UPDATE SET department = excluded.department, position = excluded.position")
+INSERT_ATTENDANCE = ("INSERT OR IGNORE INTO attendance (person_id, day, seconds, department) "
+                     "SELECT id, ?, ?, department FROM people WHERE name = ?")
+
+
+def day_number(date):
+    """20240131 for '2024-01-31' or a date"""
+    if isinstance(date, str):
+        date = datetime.datetime.strptime(date, '%Y-%m-%d')
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def day_string(day):
+    return "%04d-%02d-%02d" % (day // 10000, day // 100 % 100, day % 100)
+
+
+def seconds_of_day(time_str):
+    """32400 for '09:00:00'"""
+    hours, minutes, seconds = (int(part) for part in time_str.split(":"))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def time_string(seconds):
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def _create_v1(conn):
+    # The original table: free text per row, date and time as strings
+    conn.execute("CREATE TABLE IF NOT EXISTS attendance (name TEXT, department TEXT, position TEXT, "
+                 "time TEXT, date DATE, UNIQUE(name, date))")
+
+
+def _normalize_v2(conn):
+    conn.execute("CREATE TABLE people (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, "
+                 "department TEXT NOT NULL DEFAULT '', position TEXT NOT NULL DEFAULT '')")
+    # Oldest rows first, so people keep the department and position of their latest row
+    conn.execute("INSERT INTO people (name, department, position) "
+                 "SELECT name, COALESCE(department, ''), COALESCE(position, '') FROM attendance "
+                 "WHERE name IS NOT NULL ORDER BY date, time "
+                 "ON CONFLICT (name) DO UPDATE SET department = excluded.department, position = excluded.position")
+    conn.execute("ALTER TABLE attendance RENAME TO attendance_v1")
+    # The primary key answers person lookups, WITHOUT ROWID keeps rows in key order without a second copy;
+    # rows keep the department of the v1 row, see _attendance_department_v5
+    conn.execute("CREATE TABLE attendance (person_id INTEGER NOT NULL REFERENCES people (id), "
+                 "day INTEGER NOT NULL, seconds INTEGER NOT NULL, department TEXT NOT NULL DEFAULT '', "
+                 "PRIMARY KEY (person_id, day)) WITHOUT ROWID")
+    conn.execute("INSERT OR IGNORE INTO attendance (person_id, day, seconds, department) "
+                 "SELECT p.id, CAST(replace(v.date, '-', '') AS INTEGER), "
+                 "substr(v.time, 1, 2) * 3600 + substr(v.time, 4, 2) * 60 + substr(v.time, 7, 2), "
+                 "COALESCE(v.department, '') "
+                 "FROM attendance_v1 v JOIN people p ON p.name = v.name ORDER BY v.date, v.time")
+    conn.execute("DROP TABLE attendance_v1")
+    # Covering for the rows of a day: secondary indexes of WITHOUT ROWID tables carry the primary key
+    conn.execute("CREATE INDEX attendance_day ON attendance (day, seconds)")
+    conn.execute("CREATE INDEX people_department ON people (department)")
+
+
+def _change_markers_v3(conn):
+    # Last-change markers for caches: `changes` moves on every write, `history_changes` only when a
+    # day before today changes (late back-fills, deletions) or a person's department or position is edited
+    conn.execute("CREATE TABLE change_markers (id INTEGER PRIMARY KEY CHECK (id = 1), "
+                 "changes INTEGER NOT NULL, history_changes INTEGER NOT NULL)")
+    conn.execute("INSERT INTO change_markers VALUES (1, 0, 0)")
+    today = "CAST(strftime('%Y%m%d', 'now', 'localtime') AS INTEGER)"
+    for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+        conn.execute("CREATE TRIGGER attendance_%s_marker AFTER %s ON attendance BEGIN "
+                     "UPDATE change_markers SET changes = changes + 1, "
+                     "history_changes = history_changes + (%s.day < %s) WHERE id = 1; END"
+                     % (event.lower(), event, row, today))
+    conn.execute("CREATE TRIGGER people_insert_marker AFTER INSERT ON people BEGIN "
+                 "UPDATE change_markers SET changes = changes + 1 WHERE id = 1; END")
+    # The upsert of every mark runs this, only real edits count
+    conn.execute("CREATE TRIGGER people_update_marker AFTER UPDATE ON people "
+                 "WHEN old.name IS NOT new.name OR old.department IS NOT new.department "
+                 "OR old.position IS NOT new.position BEGIN "
+                 "UPDATE change_markers SET changes = changes + 1, history_changes = history_changes + 1 "
+                 "WHERE id = 1; END")
+
+
+# Counts and first / last arrival per day, per day and department, and per month and department
+SUMMARY_TABLES = ("daily_summary", "department_daily", "monthly_summary")
+
+
+def _summary_upsert(table, key_columns, key_values):
+    return ("INSERT INTO %s (%s, present, first_seconds, last_seconds) VALUES (%s, 1, new.seconds, new.seconds) "
+            "ON CONFLICT (%s) DO UPDATE SET present = present + 1, "
+            "first_seconds = min(first_seconds, excluded.first_seconds), "
+            "last_seconds = max(last_seconds, excluded.last_seconds);"
+            % (table, key_columns, key_values, key_columns))
+
+
+def _summary_remove(table, condition, rows):
+    # Arrival bounds of the remaining rows; only deletions pay for a scan, of one day or month
+    return ("UPDATE %s SET present = present - 1, "
+            "first_seconds = (SELECT min(a.seconds) FROM %s), last_seconds = (SELECT max(a.seconds) FROM %s) "
+            "WHERE %s;" % (table, rows, rows, condition))
+
+
+def _summaries_v4(conn):
+    conn.execute("CREATE TABLE daily_summary (day INTEGER PRIMARY KEY, present INTEGER NOT NULL, "
+                 "first_seconds INTEGER, last_seconds INTEGER)")
+    conn.execute("CREATE TABLE department_daily (day INTEGER NOT NULL, department TEXT NOT NULL, "
+                 "present INTEGER NOT NULL, first_seconds INTEGER, last_seconds INTEGER, "
+                 "PRIMARY KEY (day, department)) WITHOUT ROWID")
+    # month is YYYYMM
+    conn.execute("CREATE TABLE monthly_summary (month INTEGER NOT NULL, department TEXT NOT NULL, "
+                 "present INTEGER NOT NULL, first_seconds INTEGER, last_seconds INTEGER, "
+                 "PRIMARY KEY (month, department)) WITHOUT ROWID")
+    # The triggers that maintain the tables, and their first fill, come with _attendance_department_v5
+
+
+def _attendance_department_v5(conn):
+    # Rows keep the department the person had when they were marked, so a later change of department
+    # does not move their past attendance. A v1 database gets the column from _normalize_v2 with the
+    # department of each v1 row; one normalized by an earlier release lost it, its rows get the current one
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(attendance)")]
+    if "department" not in columns:
+        conn.execute("ALTER TABLE attendance ADD COLUMN department TEXT NOT NULL DEFAULT ''")
+        conn.execute("UPDATE attendance SET department = "
+                     "(SELECT p.department FROM people p WHERE p.id = attendance.person_id)")
+    # Databases migrated by an earlier release have triggers that read the department from `people`
+    conn.execute("DROP TRIGGER IF EXISTS attendance_insert_summary")
+    conn.execute("DROP TRIGGER IF EXISTS attendance_delete_summary")
+    # Maintained in the transaction of every insert, whichever process writes
+    conn.execute("CREATE TRIGGER attendance_insert_summary AFTER INSERT ON attendance BEGIN "
+                 + _summary_upsert("daily_summary", "day", "new.day")
+                 + _summary_upsert("department_daily", "day, department", "new.day, new.department")
+                 + _summary_upsert("monthly_summary", "month, department", "new.day / 100, new.department")
+                 + " END")
+    conn.execute("CREATE TRIGGER attendance_delete_summary AFTER DELETE ON attendance BEGIN "
+                 + _summary_remove("daily_summary", "day = old.day", "attendance a WHERE a.day = old.day")
+                 + _summary_remove("department_daily", "day = old.day AND department = old.department",
+                                   "attendance a WHERE a.day = old.day AND a.department = old.department")
+                 + _summary_remove("monthly_summary", "month = old.day / 100 AND department = old.department",
+                                   "attendance a "
+                                   "WHERE a.day BETWEEN old.day / 100 * 100 AND old.day / 100 * 100 + 99 "
+                                   "AND a.department = old.department")
+                 + " END")
+    rebuild_summaries(conn)
+
+
+# Step i brings a database from version i to version i + 1
+MIGRATIONS = (_create_v1, _normalize_v2, _change_markers_v3, _summaries_v4, _attendance_department_v5)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn):
+    """Bring the database of `conn` to SCHEMA_VERSION, return the version it had"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return version
+    # Another process may be migrating the same file, the write lock serializes them
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0 and conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                         "AND name = 'attendance'").fetchone():
+            # Created by a release before the schema was versioned
+            version = 1
+        start_version = version
+        for step in MIGRATIONS[version:]:
+            step(conn)
+        conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    if 0 < start_version < SCHEMA_VERSION:
+        logging.info("Attendance database migrated from version %d to %d", start_version, SCHEMA_VERSION)
+    return start_version
+
+
+def connect(path_db=PATH_DB, timeout=10.0):
+    """Connection to the attendance database in WAL mode, migrated to the current schema"""
+    conn = sqlite3.connect(path_db, timeout=timeout)
+    try:
+        # Readers (dashboard, statistics) no longer block the writer and the other way round
+        conn.execute("PRAGMA journal_mode = WAL")
+        # Fsync at checkpoints only: with WAL a power cut may lose the last commits but never corrupts the file
+        conn.execute("PRAGMA synchronous = NORMAL")
+        migrate(conn)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+def change_markers(conn):
+    """(changes, history_changes) counters, see _change_markers_v3"""
+    return conn.execute("SELECT changes, history_changes FROM change_markers WHERE id = 1").fetchone()
+
+
+def rebuild_summaries(conn):
+    """Recompute the summary tables from the attendance rows, with the department of each row like the triggers
+
+    Runs inside the caller's transaction.
+    """
+    for table in SUMMARY_TABLES:
+        conn.execute("DELETE FROM %s" % table)
+    conn.execute("INSERT INTO daily_summary (day, present, first_seconds, last_seconds) "
+                 "SELECT day, COUNT(*), min(seconds), max(seconds) FROM attendance GROUP BY day")
+    conn.execute("INSERT INTO department_daily (day, department, present, first_seconds, last_seconds) "
+                 "SELECT day, department, COUNT(*), min(seconds), max(seconds) "
+                 "FROM attendance GROUP BY day, department")
+    conn.execute("INSERT INTO monthly_summary (month, department, present, first_seconds, last_seconds) "
+                 "SELECT day / 100, department, SUM(present), min(first_seconds), max(last_seconds) "
+                 "FROM department_daily GROUP BY day / 100, department")
+
+
+def daily_summary(conn, date):
+    """(present, first_seconds, last_seconds) of `date`, (0, None, None) for a day without attendance"""
+    row = conn.execute("SELECT present, first_seconds, last_seconds FROM daily_summary WHERE day = ?",
+                       (day_number(date),)).fetchone()
+    return row or (0, None, None)
+
+
+def daily_summaries(conn, start, end):
+    """(day, present, first_seconds, last_seconds) of the days `start` to `end` with attendance"""
+    return conn.execute("SELECT day, present, first_seconds, last_seconds FROM daily_summary "
+                        "WHERE day BETWEEN ? AND ? AND present > 0 ORDER BY day",
+                        (day_number(start), day_number(end))).fetchall()
+
+
+def monthly_summaries(conn, start_month, end_month, department=None):
+    """(month, department, present, first_seconds, last_seconds) of months YYYYMM `start_month` to `end_month`"""
+    sql = ("SELECT month, department, present, first_seconds, last_seconds FROM monthly_summary "
+           "WHERE month BETWEEN ? AND ? AND present > 0")
+    params = [start_month, end_month]
+    if department:
+        sql += " AND department = ?"
+        params.append(department)
+    return conn.execute(sql + " ORDER BY month, department", params).fetchall()
+
+
+def attendance_of_day(conn, date):
+    """(name, department, position, time) of everyone present on `date`, by arrival"""
+    return conn.execute(ATTENDANCE_OF_DAY, (day_number(date),)).fetchall()
+
+
+def count_of_day(conn, date):
+    return conn.execute(COUNT_OF_DAY, (day_number(date),)).fetchone()[0]
+
+
+def parse_cursor(cursor):
+    """(day, seconds, person_id) of a page cursor 'day:seconds:person_id'"""
+    day, seconds, person_id = (int(part) for part in cursor.split(":"))
+    return day, seconds, person_id
+
+
+def iter_attendance(conn, start, end, department=None, position=None, person_id=None, after=None, limit=500,
+                    batch_size=200):
+    """Yield (day, seconds, person_id, name, department, position) rows of days `start` to `end`, at most `limit`
+    (None for all of them)
+
+    Rows come in (day, seconds, person_id) order and `after` is the key of the
+    last row of the previous page, so a page never skips over the rows before
+    it like OFFSET does. Rows are fetched `batch_size` at a time.
+    """
+    # The department is the one of the row, as in the summaries
+    sql = ["SELECT a.day, a.seconds, a.person_id, p.name, a.department, p.position"]
+    first_day = day_number(start)
+    if after is not None:
+        # The index seek starts at the day of the cursor, not at `start`
+        first_day = max(first_day, after[0])
+    params = [first_day, day_number(end)]
+    if person_id is None:
+        # Walk the day index in page order, the rows of a page are found without sorting the range
+        sql.append("FROM attendance a INDEXED BY attendance_day JOIN people p ON p.id = a.person_id "
+                   "WHERE a.day BETWEEN ? AND ?")
+    else:
+        sql.append("FROM attendance a JOIN people p ON p.id = a.person_id WHERE a.day BETWEEN ? AND ? "
+                   "AND a.person_id = ?")
+        params.append(person_id)
+    if department:
+        sql.append("AND a.department = ?")
+        params.append(department)
+    if position:
+        sql.append("AND p.position = ?")
+        params.append(position)
+    if after is not None:
+        # Spelled out so only the rest of the cursor's day is filtered, not the range before it
+        sql.append("AND (a.day > ? OR (a.day = ? AND (a.seconds, a.person_id) > (?, ?)))")
+        params.extend((after[0], after[0], after[1], after[2]))
+    sql.append("ORDER BY a.day, a.seconds, a.person_id LIMIT ?")
+    params.append(limit if limit is not None else -1)
+    cursor = conn.execute(" ".join(sql), params)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cursor.close()
+
+
+def iter_people(conn, department=None, position=None, after=None, limit=500):
+    """Yield (id, name, department, position) of the people with an id above `after`, in id order"""
+    sql = ["SELECT id, name, department, position FROM people WHERE id > ?"]
+    params = [after or 0]
+    if department:
+        sql.append("AND department = ?")
+        params.append(department)
+    if position:
+        sql.append("AND position = ?")
+        params.append(position)
+    sql.append("ORDER BY id LIMIT ?")
+    params.append(limit)
+    yield from conn.execute(" ".join(sql), params)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Attendance database maintenance")
+    parser.add_argument("command", choices=("migrate", "rebuild-summaries"),
+                        help="migrate: bring the database to the current schema; "
+                             "rebuild-summaries: recompute the summary tables from all attendance rows")
+    parser.add_argument("--db", default=PATH_DB, help="Path of the attendance database")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    try:
+        if args.command == "rebuild-summaries":
+            conn.execute("BEGIN IMMEDIATE")
+            rebuild_summaries(conn)
+            conn.commit()
+            days, rows = conn.execute("SELECT COUNT(*), COALESCE(SUM(present), 0) FROM daily_summary").fetchone()
+            logging.info("Summaries rebuilt: %d days, %d attendance rows", days, rows)
+        else:
+            logging.info("Attendance database at schema version %d",
+                         conn.execute("PRAGMA user_version").fetchone()[0])
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Attendance export for Face Recognition Attendance System
+Rows are read from an SQLite cursor in batches and written out as CSV or as
+an XLSX workbook as they come, so an export of any range starts right away
+and uses the same memory for a day as for years. Used by the export
+endpoints of app.py and from the command line
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import sys
+import zipfile
+from xml.sax.saxutils import escape
+
+import attendance_db
+
+HEADER = ("Date", "Time", "Name", "Department", "Position")
+
+# Rows written between two chunks of output
+CHUNK_ROWS = 500
+
+
+def export_rows(conn, start, end, department=None, position=None, person_id=None):
+    """(day, seconds, name, department, position) of every row of the range, in time order"""
+    for day, seconds, _, name, row_department, row_position in attendance_db.iter_attendance(
+            conn, start, end, department, position, person_id, limit=None):
+        yield day, seconds, name, row_department, row_position
+
+
+def iter_csv(rows):
+    """CSV text of `rows`, with a header, in chunks of CHUNK_ROWS rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADER)
+    for i, (day, seconds, name, department, position) in enumerate(rows, 1):
+        writer.writerow((attendance_db.day_string(day), attendance_db.time_string(seconds), name, department,
+                         position))
+        if i % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _ChunkSink:
+    """Write-only, unseekable file that collects what zipfile writes until it is taken"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>')
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>')
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Attendance" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>')
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>')
+# Cell formats: 0 general, 1 date (built-in format 14), 2 time (built-in format 21)
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="21" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>')
+
+_EXCEL_EPOCH = datetime.date(1899, 12, 30)
+
+
+def _text_cell(value):
+    return '<c t="inlineStr"><is><t>%s</t></is></c>' % escape(value or "")
+
+
+def _xlsx_row(day, seconds, name, department, position):
+    # Dates and times are numbers with a date / time format, so Excel can sort and filter them
+    serial_day = (datetime.date(day // 10000, day // 100 % 100, day % 100) - _EXCEL_EPOCH).days
+    return ('<row><c s="1"><v>%d</v></c><c s="2"><v>%.10f</v></c>%s%s%s</row>'
+            % (serial_day, seconds / 86400, _text_cell(name), _text_cell(department), _text_cell(position)))
+
+
+def iter_xlsx(rows):
+    """XLSX workbook of `rows` as a stream of bytes chunks
+
+    The worksheet is deflated into the zip as the rows arrive; zipfile writes
+    sizes after each entry when the output cannot seek, so nothing is buffered
+    beyond the current chunk.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as workbook:
+        workbook.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        workbook.writestr("_rels/.rels", _ROOT_RELS)
+        workbook.writestr("xl/workbook.xml", _WORKBOOK)
+        workbook.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        workbook.writestr("xl/styles.xml", _STYLES)
+        yield sink.take()
+        # force_zip64: the size of the sheet is not known in advance
+        with workbook.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                         '<cols><col min="1" max="1" width="12" customWidth="1"/>'
+                         '<col min="2" max="2" width="10" customWidth="1"/>'
+                         '<col min="3" max="5" width="22" customWidth="1"/></cols><sheetData>'
+                         '<row>%s</row>' % "".join(_text_cell(title) for title in HEADER)).encode("utf-8"))
+            lines = []
+            for i, row in enumerate(rows, 1):
+                lines.append(_xlsx_row(*row))
+                if i % CHUNK_ROWS == 0:
+                    sheet.write("".join(lines).encode("utf-8"))
+                    lines = []
+                    yield sink.take()
+            sheet.write(("".join(lines) + "</sheetData></worksheet>").encode("utf-8"))
+    yield sink.take()
+
+
+EXPORT_FORMATS = {"csv": iter_csv, "xlsx": iter_xlsx}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export attendance as CSV or Excel")
+    parser.add_argument("--from", dest="start", required=True, help="First day, YYYY-MM-DD")
+    parser.add_argument("--to", dest="end", default=None, help="Last day, YYYY-MM-DD (default: the first day)")
+    parser.add_argument("--department", default=None)
+    parser.add_argument("--position", default=None)
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default=None,
+                        help="Output format, by default from the extension of --output, else csv")
+    parser.add_argument("-o", "--output", default=None, help="Output file (default: CSV on standard output)")
+    parser.add_argument("--db", default=attendance_db.PATH_DB, help="Path of the attendance database")
+    args = parser.parse_args()
+    try:
+        for date in (args.start, args.end or args.start):
+            datetime.datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        parser.error("dates must be YYYY-MM-DD")
+    export_format = args.format or ("xlsx" if args.output and args.output.lower().endswith(".xlsx") else "csv")
+    if export_format == "xlsx" and not args.output:
+        parser.error("an Excel export needs --output")
+
+    conn = attendance_db.connect(args.db)
+    try:
+        chunks = EXPORT_FORMATS[export_format](
+            export_rows(conn, args.start, args.end or args.start, args.department, args.position))
+        if args.output:
+            if export_format == "xlsx":
+                f = open(args.output, "wb")
+            else:
+                # The csv module writes its own line endings
+                f = open(args.output, "w", newline="", encoding="utf-8")
+            with f:
+                for chunk in chunks:
+                    f.write(chunk)
+        else:
+            for chunk in chunks:
+                sys.stdout.write(chunk)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,147 @@
-import dlib
-import numpy as np
+import time
+# Start of the imports, for the startup report
+IMPORT_START = time.perf_counter()
 import cv2
 import os
-import pandas as pd
-import time
 import logging
-import sqlite3
-import datetime
-import pyttsx3
-
-
-# Dlib  / Use frontal face detector of Dlib
-detector = dlib.get_frontal_face_detector()
-
-# Dlib landmark / Get face landmarks
-predictor = dlib.shape_predictor('data/data_dlib/shape_predictor_68_face_landmarks.dat')
+import argparse
+import contextlib
+import signal
+import threading
+from face_gallery import FaceGallery, GalleryWatcher, load_gallery, load_gallery_csv, \
+    DISTANCE_THRESHOLD, PATH_GALLERY, PATH_FEATURES_CSV
+from face_index import load_or_build_index
+from face_embedding import face_landmarks, compute_descriptors
+from face_detection import ScaledDetector
+from face_tracker import FaceTracker
+from frame_pipeline import DropOldestQueue, CaptureThread, FairScheduler, PipelineStats, ThroughputStats
+from attendance_writer import AttendanceWriter
+from speech_service import SpeechService
+from stage_timer import StageTimers, StartupReport, NO_TIMERS
+from model_registry import get_predictor, get_face_reco_model, preload, MODELS
+from recognition_service import RemoteGallery, connect_service
+
+IMPORTS_DONE = time.perf_counter()
+
+
+def load_known_faces():
+    """(gallery, path) from the binary gallery, or the legacy "features_all.csv", None if there is neither"""
+    if os.path.exists(PATH_GALLERY):
+        path_features_known = PATH_GALLERY
+        start = time.time()
+        try:
+            gallery = load_gallery(path_features_known)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Could not load '%s': %s", path_features_known, e)
+            return None
+        logging.info("Gallery loaded in %.1f ms", (time.time() - start) * 1000)
+    elif os.path.exists(PATH_FEATURES_CSV):
+        path_features_known = PATH_FEATURES_CSV
+        logging.warning("Reading legacy '%s', run 'python face_gallery.py convert' "
+                        "to switch to the binary gallery", path_features_known)
+        gallery = load_gallery_csv(path_features_known)
+    else:
+        logging.warning("'%s' not found!", PATH_GALLERY)
+        logging.warning("Please run 'get_faces_from_camera_tkinter.py' "
+                        "and 'features_extraction_to_csv.py' before 'attendance_taker.py'")
+        return None
+    return gallery, path_features_known
+
+
+def embed_and_match(gallery, img_rd, rects, k=1, timers=NO_TIMERS):
+    """Descriptors of the faces at `rects` in one batch, and the ids and distances of their k closest people"""
+    with timers.stage("landmarks"):
+        shapes = face_landmarks(get_predictor(), img_rd, rects)
+    with timers.stage("descriptor"):
+        descriptors = compute_descriptors(get_face_reco_model(), img_rd, shapes)
+    with timers.stage("match"):
+        ids, distances = gallery.match(descriptors, k=k)
+    return descriptors, ids, distances
+
+
+def match_tracks(gallery, img_rd, tracks, frame_cnt, retry_interval, retry_interval_max, lock=None,
+                 timers=NO_TIMERS, rects=None, is_current=None):
+    """Embed the faces of `tracks` in one batch and settle their identity, return the descriptors
+
+    Unknown tracks are scheduled for a retry with an exponential backoff. A
+    RemoteGallery embeds and matches in the recognition service. `rects` are
+    the boxes of the tracks in `img_rd`, by default their current ones. When
+    `is_current(gallery)` turns false, the gallery was swapped and the tracks
+    reset meanwhile, and the results are dropped.
+    """
+    if rects is None:
+        rects = [track.rect for track in tracks]
+    # A few candidates per face, so the distances of a track add up over its attempts
+    if isinstance(gallery, RemoteGallery):
+        generation = gallery.generation
+        with timers.stage("match"):
+            descriptors, similar_person_ids, similar_person_distances = gallery.embed_and_match(img_rd, rects, 3)
+        if gallery.generation != generation:
+            # The candidates of the tracks are ids of the previous gallery, they cannot be added to
+            with lock or contextlib.nullcontext():
+                for track in tracks:
+                    track.forget()
+    else:
+        descriptors, similar_person_ids, similar_person_distances = embed_and_match(gallery, img_rd, rects, 3,
+                                                                                    timers)
+    for track, person_ids, distances in zip(tracks, similar_person_ids, similar_person_distances):
+        with lock or contextlib.nullcontext():
+            if is_current is not None and not is_current(gallery):
+                # Ids and names of the old gallery, the track is recognized again
+                track.pending = False
+                continue
+            track.add_matches(person_ids, distances)
+            similar_person_num, min_e_distance = track.best_match()
+            known = min_e_distance < DISTANCE_THRESHOLD
+            track.person_id = similar_person_num if known else -1
+            track.name = gallery.names[similar_person_num] if known else "unknown"
+            track.pending = False
+            track.checked_frame = frame_cnt
+            if not known:
+                track.schedule_retry(frame_cnt, retry_interval, retry_interval_max)
+        logging.debug("  Track %d recognition result: %s, e-distance %f", track.id, track.name, min_e_distance)
+    return descriptors
+
+
+class CameraStream:
+    """Capture thread, frame queue and tracker of one camera; models, gallery and writer are shared"""
+
+    def __init__(self, index, source, timers=NO_TIMERS):
+        self.index = index
+        self.name = "camera %d: %s" % (index, source)
+        self.stream = cv2.VideoCapture(source)
+        if not self.stream.isOpened():
+            logging.error("Could not open video source %r", source)
+        self.frames = DropOldestQueue(2)
+        self.capture = CaptureThread(self.stream, self.frames, timers)
+        self.face_tracker = FaceTracker()
+        self.frame_cnt = 0
+        self.throughput = ThroughputStats(name=self.name)
 
-# Dlib Resnet Use Dlib resnet50 model to get 128D face descriptor
-face_reco_model = dlib.face_recognition_model_v1("data/data_dlib/dlib_face_recognition_resnet_model_v1.dat")
+    @property
+    def finished(self):
+        return self.frames.closed and not len(self.frames)
 
-# Create a connection to the database
-conn = sqlite3.connect("attendance.db")
-cursor = conn.cursor()
 
-# Create a table for the current date
-current_date = datetime.datetime.now().strftime("%Y_%m_%d")  # Replace hyphens with underscores
-table_name = "attendance" 
-create_table_sql = f"CREATE TABLE IF NOT EXISTS {table_name} (name TEXT, department TEXT, position TEXT, time TEXT, date DATE, UNIQUE(name, date))"
-cursor.execute(create_table_sql)
+class Face_Recognizer:
+    def __init__(self, detect_scale=1.0, min_face_size=None, grayscale_detection=True, headless=False,
+                 timers=NO_TIMERS, service=None):
+        self.font = cv2.FONT_ITALIC
 
+        # Per-stage latency percentiles, disabled unless asked for on the command line
+        self.timers = timers
+        # Imports, camera, models and gallery until the first frame, logged once
+        self.startup = StartupReport(IMPORT_START)
+        self.startup.mark("imports", IMPORTS_DONE)
 
-# Commit changes and close the connection
-conn.commit()
-conn.close()
+        # Headless: no window, overlays or key polling, a throughput summary is logged instead
+        self.headless = headless
+        self.stop_event = threading.Event()
+        self.throughput = ThroughputStats()
 
-
-class Face_Recognizer:
-    def __init__(self):
-        self.font = cv2.FONT_ITALIC
+        # Detect on a downscaled grayscale copy of the frame, rectangles come back in full resolution
+        self.face_detector = ScaledDetector(scale=detect_scale, grayscale=grayscale_detection,
+                                            min_face_size=min_face_size)
 
         # FPS
         self.frame_time = 0
@@ -49,106 +153,118 @@ class Face_Recognizer:
         # cnt for frame
         self.frame_cnt = 0
 
-        #  Save the features of faces in the database
-        self.face_features_known_list = []
-        # / Save the name of faces in the database
-        self.face_name_known_list = []
-        # Save department and position information
-        self.face_department_known_list = []
-        self.face_position_known_list = []
+        # Known features as one float32 matrix for batched matching, with names, departments and positions
+        self.face_gallery = FaceGallery([])
 
-        #  List to save centroid positions of ROI in frame N-1 and N
-        self.last_frame_face_centroid_list = []
+        #  Centroids, names and positions of the faces in the current frame
         self.current_frame_face_centroid_list = []
-
-        # List to save names of objects in frame N-1 and N
-        self.last_frame_face_name_list = []
         self.current_frame_face_name_list = []
+        self.current_frame_face_position_list = []
 
         #  cnt for faces in frame N-1 and N
         self.last_frame_face_cnt = 0
         self.current_frame_face_cnt = 0
 
-        # Save the e-distance for faceX when recognizing
-        self.current_frame_face_X_e_distance_list = []
-
-        # Save the positions and names of current faces captured
-        self.current_frame_face_position_list = []
-        #  Save the features of people in current frame
+        #  Save the features of the faces recognized in current frame
         self.current_frame_face_feature_list = []
 
-        # e distance between centroid of ROI in last and current frame
-        self.last_current_frame_centroid_e_distance = 0
+        #  Faces keep a track across frames, only new tracks are embedded
+        self.face_tracker = FaceTracker()
+        self.tracks_lock = threading.Lock()
+        #  Sources of the multi-camera mode, each with its own tracker
+        self.cameras = []
 
-        #  Reclassify after 'reclassify_interval' frames
-        self.reclassify_interval_cnt = 0
+        #  Retry unknown faces after 'reclassify_interval' frames, doubling up to 'reclassify_interval_max'
         self.reclassify_interval = 10
+        self.reclassify_interval_max = 320
 
-        # Text-to-Speech engine (offline)
-        try:
-            self.tts_engine = pyttsx3.init()
-        except Exception:
-            self.tts_engine = None
+        #  Descriptors computed and faces served from their track, logged every minute
+        self.descriptor_cnt = 0
+        self.track_reuse_cnt = 0
+        self.descriptor_stats_start = time.time()
+
+        # Text-to-Speech (offline) on its own thread, repeated announcements are rate limited
+        self.speech = SpeechService(timers=timers)
+        self.speech_repeat_interval = 60
+        self.speech_unknown_interval = 10
+
+        # Writes attendance on its own thread, knows who is already present today
+        self.attendance_writer = AttendanceWriter("attendance.db", timers=timers)
 
-    #  "features_all.csv"  / Get known faces from "features_all.csv"
+        # Reloads the gallery in the background after a new enrollment
+        self.gallery_watcher = None
+
+        # Client of the recognition service: its warm models and gallery replace the local ones
+        self.service = service
+
+    #  Get known faces from the binary gallery, or the legacy "features_all.csv"
     def get_face_database(self):
-        if os.path.exists("data/features_all.csv"):
-            path_features_known_csv = "data/features_all.csv"
-            csv_rd = pd.read_csv(path_features_known_csv, header=None)
-            for i in range(csv_rd.shape[0]):
-                features_someone_arr = []
-                # New CSV structure: name, department, position, then 128 features
-                self.face_name_known_list.append(csv_rd.iloc[i][0])
-                self.face_department_known_list.append(csv_rd.iloc[i][1])
-                self.face_position_known_list.append(csv_rd.iloc[i][2])
-                for j in range(3, 131):  # Start from index 3 for features
-                    if csv_rd.iloc[i][j] == '':
-                        features_someone_arr.append('0')
-                    else:
-                        features_someone_arr.append(csv_rd.iloc[i][j])
-                self.face_features_known_list.append(features_someone_arr)
-            logging.info("Faces in Database： %d", len(self.face_features_known_list))
+        if self.service is not None:
+            self.face_gallery = RemoteGallery(self.service)
+            self.gallery_generation = self.face_gallery.generation
+            logging.info("Faces in Database of the recognition service： %d (generation %d)",
+                         len(self.face_gallery), self.face_gallery.generation)
+            self.startup.mark("gallery loaded")
             return 1
-        else:
-            logging.warning("'features_all.csv' not found!")
-            logging.warning("Please run 'get_faces_from_camera.py' "
-                            "and 'features_extraction_to_csv.py' before 'face_reco_from_camera.py'")
+        known_faces = load_known_faces()
+        if known_faces is None:
             return 0
+        self.set_face_database(*known_faces)
+        self.startup.mark("gallery loaded")
+        return 1
+
+    def set_face_database(self, gallery, path_features_known=None):
+        # Large galleries search an IVF index, small ones stay exact
+        if path_features_known is not None:
+            load_or_build_index(gallery, path_features_known)
+        self.face_gallery = gallery
+        logging.info("Faces in Database： %d (generation %d)", len(gallery), gallery.generation)
+
+    #  Reload the gallery in the background when it changes on disk; the recognition service watches its own
+    def start_gallery_watcher(self):
+        if self.service is None:
+            self.gallery_watcher = GalleryWatcher(PATH_GALLERY, prepare=load_or_build_index)
+            self.gallery_watcher.start(self.face_gallery.generation)
+
+    def stop_gallery_watcher(self):
+        if self.gallery_watcher is not None:
+            self.gallery_watcher.stop()
+
+    #  Swap in a gallery reloaded in the background, only ever called between two frames
+    def update_face_database(self):
+        if self.service is not None:
+            # The remote gallery follows the service on its answers, the tracks have to follow it too
+            if self.face_gallery.generation != self.gallery_generation:
+                self.gallery_generation = self.face_gallery.generation
+                logging.info("Faces in Database of the recognition service： %d (generation %d)",
+                             len(self.face_gallery), self.gallery_generation)
+                self.reset_names()
+            return
+        if self.gallery_watcher is None:
+            return
+        gallery = self.gallery_watcher.take()
+        if gallery is None:
+            return
+        self.set_face_database(gallery)
+        self.reset_names()
+
+    #  Names of faces on screen may refer to the old gallery, recognize them again
+    def reset_names(self):
+        with self.tracks_lock:
+            self.face_tracker.reset_names()
+            for camera in self.cameras:
+                camera.face_tracker.reset_names()
 
     def update_fps(self):
         now = time.time()
         # Refresh fps per second
-        if str(self.start_time).split(".")[0] != str(now).split(".")[0]:
+        if int(self.start_time) != int(now):
             self.fps_show = self.fps
         self.start_time = now
         self.frame_time = now - self.frame_start_time
         self.fps = 1.0 / self.frame_time
         self.frame_start_time = now
 
-    @staticmethod
-    # / Compute the e-distance between two 128D features
-    def return_euclidean_distance(feature_1, feature_2):
-        feature_1 = np.array(feature_1)
-        feature_2 = np.array(feature_2)
-        dist = np.sqrt(np.sum(np.square(feature_1 - feature_2)))
-        return dist
-
-    # / Use centroid tracker to link face_x in current frame with person_x in last frame
-    def centroid_tracker(self):
-        for i in range(len(self.current_frame_face_centroid_list)):
-            e_distance_current_frame_person_x_list = []
-            #  For object 1 in current_frame, compute e-distance with object 1/2/3/4/... in last frame
-            for j in range(len(self.last_frame_face_centroid_list)):
-                self.last_current_frame_centroid_e_distance = self.return_euclidean_distance(
-                    self.current_frame_face_centroid_list[i], self.last_frame_face_centroid_list[j])
-
-                e_distance_current_frame_person_x_list.append(
-                    self.last_current_frame_centroid_e_distance)
-
-            last_frame_num = e_distance_current_frame_person_x_list.index(
-                min(e_distance_current_frame_person_x_list))
-            self.current_frame_face_name_list[i] = self.last_frame_face_name_list[last_frame_num]
-
     #  cv2 window / putText on cv2 window
     def draw_note(self, img_rd):
         #  / Add some info on windows
@@ -171,205 +287,370 @@ class Face_Recognizer:
     # insert data in database
 
     def attendance(self, name, department="", position=""):
-        current_date = datetime.datetime.now().strftime('%Y-%m-%d')
-        conn = sqlite3.connect("attendance.db")
-        cursor = conn.cursor()
-        # Check if the name already has an entry for the current date
-        cursor.execute("SELECT * FROM attendance WHERE name = ? AND date = ?", (name, current_date))
-        existing_entry = cursor.fetchone()
-
-        if existing_entry:
+        # Only the first sighting of the day is queued for the database, on the writer thread
+        with self.timers.stage("db"):
+            newly_marked, current_date, current_time = self.attendance_writer.mark(name, department, position)
+
+        if not newly_marked:
             print(f"{name} is already marked as present for {current_date}")
             # Optional: announce already marked
-            if self.tts_engine:
-                try:
-                    self.tts_engine.say(f"{name} already present for {current_date}")
-                    self.tts_engine.runAndWait()
-                except Exception:
-                    pass
+            with self.timers.stage("speech"):
+                self.speech.say(f"{name} already present for {current_date}", key=name,
+                                rate_limit=self.speech_repeat_interval)
         else:
-            current_time = datetime.datetime.now().strftime('%H:%M:%S')
-            cursor.execute("INSERT INTO attendance (name, department, position, time, date) VALUES (?, ?, ?, ?, ?)", 
-                          (name, department, position, current_time, current_date))
-            conn.commit()
             print(f"{name} ({department}, {position}) marked as present for {current_date} at {current_time}")
-            if self.tts_engine:
-                try:
-                    dept_info = f" from {department}" if department else ""
-                    pos_info = f", {position}" if position else ""
-                    self.tts_engine.say(f"{name}{dept_info}{pos_info} present at {current_time}")
-                    self.tts_engine.runAndWait()
-                except Exception:
-                    pass
-
-        conn.close()
-
-    #  Face detection and recognition wit OT from input video stream
+            dept_info = f" from {department}" if department else ""
+            pos_info = f", {position}" if position else ""
+            with self.timers.stage("speech"):
+                self.speech.say(f"{name}{dept_info}{pos_info} present at {current_time}", key=name, rate_limit=0)
+
+    #  Embed the faces of `tracks` in one batch, match them against the database and mark attendance
+    def recognize_tracks(self, img_rd, tracks, frame_cnt, rects=None):
+        gallery = self.face_gallery
+        self.current_frame_face_feature_list = match_tracks(gallery, img_rd, tracks, frame_cnt,
+                                                            self.reclassify_interval, self.reclassify_interval_max,
+                                                            self.tracks_lock, self.timers, rects,
+                                                            lambda used: used is self.face_gallery)
+        self.descriptor_cnt += len(tracks)
+        for track in tracks:
+            if track.person_id >= 0:
+                # Insert attendance record with department and position
+                self.attendance(*gallery.person(track.person_id))
+            elif track.attempts == 1:
+                with self.timers.stage("speech"):
+                    self.speech.say("Unknown person detected", rate_limit=self.speech_unknown_interval)
+
+    #  Log how many descriptors were computed and how many faces reused the result of their track
+    def update_descriptor_stats(self, tracks_cnt, computed_cnt):
+        self.track_reuse_cnt += tracks_cnt - computed_cnt
+        now = time.time()
+        if now - self.descriptor_stats_start >= 60:
+            minutes = (now - self.descriptor_stats_start) / 60
+            logging.info("Descriptors: %.1f computed / min, %.1f faces / min served from their track",
+                         self.descriptor_cnt / minutes, self.track_reuse_cnt / minutes)
+            self.descriptor_cnt = 0
+            self.track_reuse_cnt = 0
+            self.descriptor_stats_start = now
+
+    #  Positions, centroids and names of the tracked faces, drawn under their ROI
+    def draw_tracks(self, img_rd, faces, tracks):
+        self.current_frame_face_name_list = [track.name or "unknown" for track in tracks]
+        self.current_frame_face_centroid_list = [track.centroid for track in tracks]
+        self.current_frame_face_position_list = [
+            tuple([d.left(), int(d.bottom() + (d.bottom() - d.top()) / 4)]) for d in faces]
+        for d, name, position in zip(faces, self.current_frame_face_name_list,
+                                     self.current_frame_face_position_list):
+            img_rd = cv2.rectangle(img_rd, tuple([d.left(), d.top()]), tuple([d.right(), d.bottom()]),
+                                   (255, 255, 255), 2)
+            img_rd = cv2.putText(img_rd, name, position, self.font, 0.8, (0, 255, 255), 1, cv2.LINE_AA)
+        self.draw_note(img_rd)
+
+    #  Face detection and recognition with OT from input video stream
     def process(self, stream):
-        # 1.  Get faces known from "features.all.csv"
+        # 1.  Get faces known from the gallery
         if self.get_face_database():
-            while stream.isOpened():
+            self.start_gallery_watcher()
+            while stream.isOpened() and not self.stop_event.is_set():
+                self.update_face_database()
                 self.frame_cnt += 1
-                logging.debug("Frame " + str(self.frame_cnt) + " starts")
-                flag, img_rd = stream.read()
-                kk = cv2.waitKey(1)
+                logging.debug("Frame %d starts", self.frame_cnt)
+                with self.timers.stage("read"):
+                    flag, img_rd = stream.read()
+                if not flag:
+                    break
 
                 # 2.  Detect faces for frame X
-                faces = detector(img_rd, 0)
+                with self.timers.stage("detect"):
+                    faces = self.face_detector(img_rd)
 
                 # 3.  Update cnt for faces in frames
                 self.last_frame_face_cnt = self.current_frame_face_cnt
                 self.current_frame_face_cnt = len(faces)
 
-                # 4.  Update the face name list in last frame
-                self.last_frame_face_name_list = self.current_frame_face_name_list[:]
-
-                # 5.  update frame centroid list
-                self.last_frame_face_centroid_list = self.current_frame_face_centroid_list
-                self.current_frame_face_centroid_list = []
-
-                # 6.1  if cnt not changes
-                if (self.current_frame_face_cnt == self.last_frame_face_cnt) and (
-                        self.reclassify_interval_cnt != self.reclassify_interval):
-                    logging.debug("scene 1:   No face cnt changes in this frame!!!")
-
-                    self.current_frame_face_position_list = []
-
-                    if "unknown" in self.current_frame_face_name_list:
-                        self.reclassify_interval_cnt += 1
-
-                    if self.current_frame_face_cnt != 0:
-                        for k, d in enumerate(faces):
-                            self.current_frame_face_position_list.append(tuple(
-                                [faces[k].left(), int(faces[k].bottom() + (faces[k].bottom() - faces[k].top()) / 4)]))
-                            self.current_frame_face_centroid_list.append(
-                                [int(faces[k].left() + faces[k].right()) / 2,
-                                 int(faces[k].top() + faces[k].bottom()) / 2])
+                # 4.  Link the faces to their tracks; a face stays recognized while it is tracked,
+                #     only new faces and unknown faces due for a retry get a descriptor
+                with self.timers.stage("track"):
+                    tracks = self.face_tracker.update(faces)
+                tracks_to_recognize = [track for track in tracks if track.needs_recognition(self.frame_cnt)]
+                if tracks_to_recognize:
+                    logging.debug("  %d of %d faces to recognize", len(tracks_to_recognize), len(tracks))
+                    self.recognize_tracks(img_rd, tracks_to_recognize, self.frame_cnt)
+                self.update_descriptor_stats(len(tracks), len(tracks_to_recognize))
+
+                self.startup.frame_done()
+                if self.headless:
+                    self.throughput.frame_done(len(faces), len(tracks_to_recognize))
+                    self.throughput.report()
+                else:
+                    with self.timers.stage("render"):
+                        # 5.  / Add names and note on cv2 window
+                        self.draw_tracks(img_rd, faces, tracks)
 
-                            img_rd = cv2.rectangle(img_rd,
-                                                   tuple([d.left(), d.top()]),
-                                                   tuple([d.right(), d.bottom()]),
-                                                   (255, 255, 255), 2)
+                        self.update_fps()
+                        cv2.namedWindow("camera", 1)
+                        cv2.imshow("camera", img_rd)
+                        key = cv2.waitKey(1)
 
-                    #  Multi-faces in current frame, use centroid-tracker to track
-                    if self.current_frame_face_cnt != 1:
-                        self.centroid_tracker()
+                    # 6.  'q'  / Press 'q' to exit
+                    if key == ord('q'):
+                        break
+                self.timers.report()
 
-                    for i in range(self.current_frame_face_cnt):
-                        # 6.2 Write names under ROI
-                        img_rd = cv2.putText(img_rd, self.current_frame_face_name_list[i],
-                                             self.current_frame_face_position_list[i], self.font, 0.8, (0, 255, 255), 1,
-                                             cv2.LINE_AA)
-                    self.draw_note(img_rd)
+                logging.debug("Frame ends\n\n")
 
-                # 6.2  If cnt of faces changes, 0->1 or 1->0 or ...
-                else:
-                    logging.debug("scene 2: / Faces cnt changes in this frame")
-                    self.current_frame_face_position_list = []
-                    self.current_frame_face_X_e_distance_list = []
-                    self.current_frame_face_feature_list = []
-                    self.reclassify_interval_cnt = 0
-
-                    # 6.2.1  Face cnt decreases: 1->0, 2->1, ...
-                    if self.current_frame_face_cnt == 0:
-                        logging.debug("  / No faces in this frame!!!")
-                        # clear list of names and features
-                        self.current_frame_face_name_list = []
-                    # 6.2.2 / Face cnt increase: 0->1, 0->2, ..., 1->2, ...
-                    else:
-                        logging.debug("  scene 2.2  Get faces in this frame and do face recognition")
-                        self.current_frame_face_name_list = []
-                        for i in range(len(faces)):
-                            shape = predictor(img_rd, faces[i])
-                            self.current_frame_face_feature_list.append(
-                                face_reco_model.compute_face_descriptor(img_rd, shape))
-                            self.current_frame_face_name_list.append("unknown")
-
-                        # 6.2.2.1 Traversal all the faces in the database
-                        for k in range(len(faces)):
-                            logging.debug("  For face %d in current frame:", k + 1)
-                            self.current_frame_face_centroid_list.append(
-                                [int(faces[k].left() + faces[k].right()) / 2,
-                                 int(faces[k].top() + faces[k].bottom()) / 2])
-
-                            self.current_frame_face_X_e_distance_list = []
-
-                            # 6.2.2.2  Positions of faces captured
-                            self.current_frame_face_position_list.append(tuple(
-                                [faces[k].left(), int(faces[k].bottom() + (faces[k].bottom() - faces[k].top()) / 4)]))
-
-                            # 6.2.2.3 
-                            # For every faces detected, compare the faces in the database
-                            for i in range(len(self.face_features_known_list)):
-                                # 
-                                if str(self.face_features_known_list[i][0]) != '0.0':
-                                    e_distance_tmp = self.return_euclidean_distance(
-                                        self.current_frame_face_feature_list[k],
-                                        self.face_features_known_list[i])
-                                    logging.debug("      with person %d, the e-distance: %f", i + 1, e_distance_tmp)
-                                    self.current_frame_face_X_e_distance_list.append(e_distance_tmp)
-                                else:
-                                    #  person_X
-                                    self.current_frame_face_X_e_distance_list.append(999999999)
-
-                            # 6.2.2.4 / Find the one with minimum e distance
-                            similar_person_num = self.current_frame_face_X_e_distance_list.index(
-                                min(self.current_frame_face_X_e_distance_list))
-
-                            if min(self.current_frame_face_X_e_distance_list) < 0.4:
-                                self.current_frame_face_name_list[k] = self.face_name_known_list[similar_person_num]
-                                logging.debug("  Face recognition result: %s",
-                                              self.face_name_known_list[similar_person_num])
-                                
-                                # Insert attendance record with department and position
-                                nam = self.face_name_known_list[similar_person_num]
-                                dept = self.face_department_known_list[similar_person_num]
-                                pos = self.face_position_known_list[similar_person_num]
-
-                                print(type(self.face_name_known_list[similar_person_num]))
-                                print(nam)
-                                self.attendance(nam, dept, pos)
-                            else:
-                                logging.debug("  Face recognition result: Unknown person")
-                                if self.tts_engine:
-                                    try:
-                                        self.tts_engine.say("Unknown person detected")
-                                        self.tts_engine.runAndWait()
-                                    except Exception:
-                                        pass
-
-                        # 7.  / Add note on cv2 window
-                        self.draw_note(img_rd)
-
-                # 8.  'q'  / Press 'q' to exit
-                if kk == ord('q'):
+            self.stop_gallery_watcher()
+            self.timers.report(force=True)
+
+    #  Pipelined mode: name the faces of recognition jobs, off the display thread
+    def recognition_worker(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            frame_cnt, img_rd, tracks, rects = job
+            self.recognize_tracks(img_rd, tracks, frame_cnt, rects)
+
+    #  Face detection and recognition with capture, detection / tracking and recognition on their own threads
+    def process_pipelined(self, stream):
+        if not self.get_face_database():
+            return
+        self.start_gallery_watcher()
+
+        # Small queues that drop the oldest item: the display never waits on a backlog
+        frames = DropOldestQueue(2)
+        jobs = DropOldestQueue(2)
+        capture = CaptureThread(stream, frames, self.timers)
+        capture.start()
+        worker = threading.Thread(target=self.recognition_worker, args=(jobs,),
+                                  name="RecognitionWorker", daemon=True)
+        worker.start()
+        stats = PipelineStats()
+
+        while not self.stop_event.is_set():
+            item = frames.get(timeout=1.0)
+            if item is None:
+                if frames.closed:
                     break
+                continue
+            self.frame_cnt, capture_time, img_rd = item
+            self.update_face_database()
+
+            # Detection and tracking on the freshest frame
+            with self.timers.stage("detect"):
+                faces = self.face_detector(img_rd)
+            self.last_frame_face_cnt = self.current_frame_face_cnt
+            self.current_frame_face_cnt = len(faces)
+            with self.timers.stage("track"):
+                tracks = self.face_tracker.update(faces)
+
+            # New faces, and unknown ones when their backoff expires, go to the recognition worker
+            with self.tracks_lock:
+                tracks_to_recognize = [track for track in tracks if track.needs_recognition(self.frame_cnt)]
+                for track in tracks_to_recognize:
+                    track.pending = True
+            self.update_descriptor_stats(len(tracks), len(tracks_to_recognize))
+            if tracks_to_recognize:
+                # The frame is drawn on below, the worker gets its own copy; the boxes are taken
+                # now, the tracker moves the tracks on to the next frame before the worker runs
+                rects = [track.rect for track in tracks_to_recognize]
+                dropped_job = jobs.put((self.frame_cnt, img_rd.copy(), tracks_to_recognize, rects))
+                if dropped_job is not None:
+                    with self.tracks_lock:
+                        for track in dropped_job[2]:
+                            track.pending = False
+
+            self.startup.frame_done()
+            self.timers.report()
+            if self.headless:
+                self.throughput.frame_done(len(faces), len(tracks_to_recognize))
+                self.throughput.report()
+                stats.frame_shown(capture_time)
+                stats.report(frames, jobs)
+                continue
+
+            with self.timers.stage("render"):
+                # Results of the worker are already attached to the tracks
+                with self.tracks_lock:
+                    self.draw_tracks(img_rd, faces, tracks)
 
                 self.update_fps()
                 cv2.namedWindow("camera", 1)
                 cv2.imshow("camera", img_rd)
+                key = cv2.waitKey(1)
+            stats.frame_shown(capture_time)
+            stats.report(frames, jobs)
+
+            # 'q'  / Press 'q' to exit
+            if key == ord('q'):
+                break
+
+        capture.stop()
+        jobs.close()
+        worker.join(timeout=5)
+        # run() releases the stream when this returns, not while the capture thread is in read()
+        capture.join(timeout=1)
+        self.stop_gallery_watcher()
+        stats.report(frames, jobs, force=True)
+        self.timers.report(force=True)
+
+    #  Multi-camera mode: one capture thread and tracker per source, detection round robin over the
+    #  cameras, recognition jobs of all cameras served fairly by one worker
+    def process_multi(self, sources):
+        if not self.get_face_database():
+            return
+        self.start_gallery_watcher()
+
+        cameras = self.cameras = [CameraStream(i, source, self.timers) for i, source in enumerate(sources)]
+        self.startup.mark("cameras opened")
+        scheduler = FairScheduler(len(cameras))
+        worker = threading.Thread(target=self.recognition_worker, args=(scheduler,),
+                                  name="RecognitionWorker", daemon=True)
+        worker.start()
+        for camera in cameras:
+            camera.capture.start()
+
+        while not self.stop_event.is_set() and not all(camera.finished for camera in cameras):
+            self.update_face_database()
+            frames_cnt = 0
+            # One frame per camera and round, the freshest each camera has
+            for camera in cameras:
+                item = camera.frames.get(timeout=0)
+                if item is None:
+                    continue
+                frames_cnt += 1
+                camera.frame_cnt, _, img_rd = item
+                with self.timers.stage("detect"):
+                    faces = self.face_detector(img_rd)
+                with self.timers.stage("track"):
+                    tracks = camera.face_tracker.update(faces)
+
+                with self.tracks_lock:
+                    tracks_to_recognize = [track for track in tracks
+                                           if track.needs_recognition(camera.frame_cnt)]
+                    for track in tracks_to_recognize:
+                        track.pending = True
+                self.update_descriptor_stats(len(tracks), len(tracks_to_recognize))
+                if tracks_to_recognize:
+                    rects = [track.rect for track in tracks_to_recognize]
+                    dropped_job = scheduler.put(camera.index, (camera.frame_cnt, img_rd.copy(), tracks_to_recognize,
+                                                               rects))
+                    if dropped_job is not None:
+                        with self.tracks_lock:
+                            for track in dropped_job[2]:
+                                track.pending = False
+
+                self.startup.frame_done()
+                camera.throughput.frame_done(len(faces), len(tracks_to_recognize))
+                camera.throughput.report()
+                if not self.headless:
+                    # The note shows the numbers of the camera the frame comes from
+                    self.frame_cnt = camera.frame_cnt
+                    self.fps = camera.throughput.fps
+                    self.current_frame_face_cnt = len(faces)
+                    with self.timers.stage("render"), self.tracks_lock:
+                        self.draw_tracks(img_rd, faces, tracks)
+                        cv2.imshow(camera.name, img_rd)
+
+            self.timers.report()
+            if not self.headless and cv2.waitKey(1) == ord('q'):
+                break
+            if not frames_cnt:
+                time.sleep(0.005)
+
+        for camera in cameras:
+            camera.capture.stop()
+        scheduler.close()
+        worker.join(timeout=5)
+        self.stop_gallery_watcher()
+        for camera in cameras:
+            camera.throughput.report(force=True)
+            logging.info("Recognition [%s]: %d jobs served, %d dropped", camera.name,
+                         scheduler.served[camera.index], scheduler.dropped[camera.index])
+            camera.capture.join(timeout=1)
+            camera.stream.release()
+        self.timers.report(force=True)
+
+    #  Stop after the current frame, e.g. on SIGINT / SIGTERM
+    def stop(self, signum=None, frame=None):
+        if signum is not None:
+            logging.info("Received signal %d, stopping", signum)
+        self.stop_event.set()
+
+    def run(self, pipelined=False, sources=(0,)):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        # The models load on a background thread while the camera opens; the recognition service
+        # has its own, only the detector is needed here
+        preload(names=("detector",) if self.service is not None else MODELS,
+                callback=lambda: self.startup.mark("models loaded"))
+        if len(sources) > 1:
+            # Several cameras share the models, the gallery and the attendance writer
+            self.process_multi(sources)
+        else:
+            # Camera index, video file or stream URL
+            cap = cv2.VideoCapture(sources[0])
+            if not cap.isOpened():
+                logging.error("Could not open video source %r", sources[0])
+            self.startup.mark("camera opened")
+            if pipelined:
+                self.process_pipelined(cap)
+            else:
+                self.process(cap)
+            if self.headless:
+                self.throughput.report(force=True)
+            cap.release()
+        self.attendance_writer.close()
+        self.speech.close()
+        if self.service is not None:
+            self.service.close()
 
-                logging.debug("Frame ends\n\n")
-
-    
+        if not self.headless:
+            cv2.destroyAllWindows()
 
 
-    def run(self):
-        # cap = cv2.VideoCapture("video.mp4")  # Get video stream from video file
-        cap = cv2.VideoCapture(0)              # Get video stream from camera
-        self.process(cap)
+def parse_source(source):
+    """Device index for digits, otherwise a file path or URL passed to cv2.VideoCapture as is"""
+    return int(source) if source.isdigit() else source
 
-        cap.release()
-        cv2.destroyAllWindows()
-    
-   
 
 
 def main():
     # logging.basicConfig(level=logging.DEBUG) # Set log level to 'logging.DEBUG' to print debug info of every frame
     logging.basicConfig(level=logging.INFO)
-    Face_Recognizer_con = Face_Recognizer()
-    Face_Recognizer_con.run()
+    parser = argparse.ArgumentParser(description="Take attendance with face recognition")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Run capture, detection and recognition on separate threads")
+    parser.add_argument("--detect-scale", type=float, default=1.0,
+                        help="Scale of the frame the face detector runs on, e.g. 0.5")
+    parser.add_argument("--min-face-size", type=int, default=None,
+                        help="Smallest face to detect in pixels, picks the detection scale automatically")
+    parser.add_argument("--color-detection", action="store_true",
+                        help="Detect faces on the color frame instead of a grayscale copy")
+    parser.add_argument("--headless", action="store_true",
+                        help="No window or overlays, log a throughput summary instead")
+    parser.add_argument("--stage-timers", action="store_true",
+                        help="Log p50 / p95 / p99 latency of every stage of the frame loop")
+    parser.add_argument("--stats-interval", type=float, default=30.0, help="Seconds between stage timer reports")
+    parser.add_argument("--stats-file", default=None, help="Also append the stage timer reports to this JSON lines file")
+    parser.add_argument("--use-service", action="store_true",
+                        help="Embed and match faces in the running recognition service instead of loading the models")
+    parser.add_argument("--source", nargs="+", default=["0"],
+                        help="Camera index, video file or stream URL (default: camera 0); "
+                             "several sources are served by one process")
+    args = parser.parse_args()
+
+    service = None
+    if args.use_service:
+        service = connect_service()
+        if service is None:
+            logging.warning("Recognition service not running, loading the models locally")
+    Face_Recognizer_con = Face_Recognizer(detect_scale=args.detect_scale, min_face_size=args.min_face_size,
+                                          grayscale_detection=not args.color_detection, headless=args.headless,
+                                          timers=StageTimers(args.stage_timers or bool(args.stats_file),
+                                                             args.stats_interval, args.stats_file),
+                                          service=service)
+    Face_Recognizer_con.run(pipelined=args.pipelined,
+                            sources=[parse_source(source) for source in args.source])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+"""
+Attendance writer for Face Recognition Attendance System
+One thread owns the SQLite connection and commits inserts in small batches,
+while an in-memory set of the people already marked today answers repeat
+sightings without touching the disk
+"""
+
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import attendance_db
+from stage_timer import NO_TIMERS
+
+
+class AttendanceWriter:
+    def __init__(self, path_db="attendance.db", commit_interval=0.5, timers=NO_TIMERS):
+        self.path_db = path_db
+        self.timers = timers
+        # Inserts are committed together at most every 'commit_interval' seconds
+        self.commit_interval = commit_interval
+
+        # Created or migrated by the writer, so importing the recognizer has no side effects
+        attendance_db.connect(self.path_db).close()
+
+        self.records = queue.Queue()
+        self.lock = threading.Lock()
+        self.date = None
+        self.present = set()
+        self.rollover(datetime.date.today().strftime('%Y-%m-%d'))
+
+        self.inserted = 0
+        self.commits = 0
+        self.thread = threading.Thread(target=self._write, name="AttendanceWriter", daemon=True)
+        self.thread.start()
+
+    def rollover(self, date):
+        """Switch the presence set to `date`, seeded from the rows already in the database"""
+        conn = attendance_db.connect(self.path_db)
+        try:
+            names = {row[0] for row in conn.execute(attendance_db.NAMES_OF_DAY, (attendance_db.day_number(date),))}
+        finally:
+            conn.close()
+        with self.lock:
+            self.date = date
+            self.present = names
+        logging.info("Attendance for %s: %d already present", date, len(names))
+
+    def is_present(self, name):
+        with self.lock:
+            return name in self.present
+
+    def mark(self, name, department="", position="", when=None):
+        """Mark `name` present, return (newly_marked, date, time)
+
+        Repeat sightings on the same day return False and never reach the disk.
+        """
+        when = when or datetime.datetime.now()
+        date = when.strftime('%Y-%m-%d')
+        time_str = when.strftime('%H:%M:%S')
+        if date != self.date:
+            # First mark after midnight
+            self.rollover(date)
+        with self.lock:
+            if name in self.present:
+                return False, date, time_str
+            self.present.add(name)
+        self.records.put((name, department, position, attendance_db.day_number(when),
+                          when.hour * 3600 + when.minute * 60 + when.second))
+        return True, date, time_str
+
+    def _write(self):
+        conn = attendance_db.connect(self.path_db)
+        try:
+            while True:
+                record = self.records.get()
+                if record is None:
+                    break
+                # Gather what arrives within the commit window into one transaction
+                batch = [record]
+                deadline = time.time() + self.commit_interval
+                stop = False
+                while True:
+                    try:
+                        record = self.records.get(timeout=max(0.0, deadline - time.time()))
+                    except queue.Empty:
+                        break
+                    if record is None:
+                        stop = True
+                        break
+                    batch.append(record)
+                try:
+                    with self.timers.stage("db_commit"), conn:
+                        conn.executemany(attendance_db.UPSERT_PERSON,
+                                         [(name, department, position) for name, department, position, _, _ in batch])
+                        conn.executemany(attendance_db.INSERT_ATTENDANCE,
+                                         [(day, seconds, name) for name, _, _, day, seconds in batch])
+                    self.inserted += len(batch)
+                    self.commits += 1
+                except sqlite3.Error as e:
+                    logging.error("Could not write %d attendance records: %s", len(batch), e)
+                if stop:
+                    break
+        finally:
+            conn.close()
+
+    def close(self):
+        """Write what is still queued and stop the writer thread"""
+        self.records.put(None)
+        self.thread.join()
+        logging.info("Attendance writer: %d records in %d commits", self.inserted, self.commits)
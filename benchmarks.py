@@ -0,0 +1,341 @@
+"""
+Benchmark suite for Face Recognition Attendance System
+Runs offline on synthetic data: gallery load and matching, face detection and
+descriptors, attendance inserts and dashboard queries. Results are written as
+JSON so runs of different versions can be compared
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import attendance_db
+from attendance_writer import AttendanceWriter
+from face_gallery import DESCRIPTOR_SIZE, load_gallery, save_gallery
+from face_index import load_or_build_index, random_gallery
+
+GALLERY_SIZES = (1000, 10000, 100000, 1000000)
+
+# Entry points whose import time is measured; importing them must not load models or touch the disk
+ENTRY_MODULES = ("attendance_taker", "features_extraction_to_csv", "video_batch", "face_gallery", "face_index")
+
+# Queries of the web dashboard and the desktop statistics
+DASHBOARD_QUERIES = {
+    "attendance_of_day": attendance_db.ATTENDANCE_OF_DAY,
+    "count_of_day": attendance_db.COUNT_OF_DAY,
+    "departments_of_day": attendance_db.DEPARTMENTS_OF_DAY,
+}
+
+
+def percentiles(seconds):
+    """Latency summary in milliseconds"""
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    return {"n": int(ms.size), "mean_ms": round(float(ms.mean()), 4),
+            "p50_ms": round(float(np.percentile(ms, 50)), 4),
+            "p95_ms": round(float(np.percentile(ms, 95)), 4),
+            "p99_ms": round(float(np.percentile(ms, 99)), 4)}
+
+
+def bench_gallery(sizes=GALLERY_SIZES, n_queries=200, noise=0.05, seed=0):
+    """Load time of the saved gallery, index build / load and single-face matching latency"""
+    results = []
+    rng = np.random.default_rng(seed + 1)
+    for size in sizes:
+        gallery = random_gallery(size, seed)
+        targets = rng.choice(size, min(n_queries, size), replace=False)
+        queries = gallery.features[targets] + noise * rng.standard_normal((len(targets), DESCRIPTOR_SIZE),
+                                                                          dtype=np.float32)
+        with tempfile.TemporaryDirectory() as path_dir:
+            path_gallery = os.path.join(path_dir, "features_all.json")
+            save_gallery(gallery, path_gallery)
+            del gallery
+
+            result = {"size": size}
+            start = time.perf_counter()
+            gallery = load_gallery(path_gallery)
+            result["load_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            # First start after an enrollment builds the index, later starts load it
+            start = time.perf_counter()
+            load_or_build_index(gallery, path_gallery)
+            result["index_build_s"] = round(time.perf_counter() - start, 3)
+            start = time.perf_counter()
+            load_or_build_index(gallery, path_gallery)
+            result["index_load_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            result["indexed"] = gallery.index is not None
+
+            latencies = []
+            hits = 0
+            for target, query in zip(targets, queries):
+                start = time.perf_counter()
+                ids, _ = gallery.match(query[None, :], k=1)
+                latencies.append(time.perf_counter() - start)
+                hits += int(ids[0, 0] == target)
+            result["match"] = percentiles(latencies)
+            result["match"]["recall"] = hits / len(targets)
+            # The memmap has to be closed before the directory can be removed on Windows
+            del gallery
+        logging.info("Gallery %d: load %.1f ms, match p50 %.3f ms", size, result["load_ms"],
+                     result["match"]["p50_ms"])
+        results.append(result)
+    return results
+
+
+def synthetic_frames(count=20, seed=0):
+    """640x480 BGR frames of noise with a bright oval in the middle, where faces usually are"""
+    import cv2
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(count):
+        img = rng.integers(0, 255, (480, 640, 3), dtype=np.uint8)
+        cv2.ellipse(img, (320, 240), (80, 105), 0, 0, 360, (150, 170, 200), -1)
+        frames.append(img)
+    return frames
+
+
+def read_frames(path, count=20):
+    """Frames of a video, or the images of a folder"""
+    import cv2
+    frames = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path))[:count]:
+            img = cv2.imread(os.path.join(path, name))
+            if img is not None:
+                frames.append(img)
+    else:
+        stream = cv2.VideoCapture(path)
+        while len(frames) < count:
+            flag, img = stream.read()
+            if not flag:
+                break
+            frames.append(img)
+        stream.release()
+    return frames
+
+
+def bench_recognition(frames, scales=(1.0, 0.5), repeat=3):
+    """Detection fps per scale and descriptor throughput, per face and in batches
+
+    Needs dlib and its models; descriptors are computed on the detected faces, or
+    on the middle of the frame when none is found.
+    """
+    import dlib
+    from model_registry import get_detector, get_predictor, get_face_reco_model
+    from face_detection import ScaledDetector
+    from face_embedding import embed_faces
+    detector, predictor, face_reco_model = get_detector(), get_predictor(), get_face_reco_model()
+
+    results = {"frames": len(frames), "detection": [], "descriptors": []}
+    faces_list = []
+    for scale in scales:
+        face_detector = ScaledDetector(detector, scale=scale)
+        latencies = []
+        faces_cnt = 0
+        for _ in range(repeat):
+            faces_list = []
+            for img in frames:
+                start = time.perf_counter()
+                faces = face_detector(img)
+                latencies.append(time.perf_counter() - start)
+                faces_cnt += len(faces)
+                faces_list.append(faces)
+        result = {"scale": scale, "faces_per_frame": faces_cnt / (repeat * len(frames))}
+        result.update(percentiles(latencies))
+        result["fps"] = round(1000 / result["mean_ms"], 2) if result["mean_ms"] else None
+        results["detection"].append(result)
+
+    rects = []
+    for img, faces in zip(frames, faces_list):
+        height, width = img.shape[:2]
+        rects.append(list(faces) or [dlib.rectangle(width // 2 - 80, height // 2 - 100,
+                                                    width // 2 + 80, height // 2 + 100)])
+    for batch_size in (1, 4):
+        descriptors_cnt = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for img, faces in zip(frames, rects):
+                # The same face repeated stands for a frame with several people
+                batch = (faces * batch_size)[:max(batch_size, len(faces))]
+                descriptors_cnt += len(embed_faces(predictor, face_reco_model, img, batch))
+        seconds = time.perf_counter() - start
+        results["descriptors"].append({"batch_size": batch_size, "descriptors": descriptors_cnt,
+                                       "per_second": round(descriptors_cnt / seconds, 2) if seconds else None})
+    return results
+
+
+def bench_attendance_inserts(records=5000):
+    """Records per second through the AttendanceWriter, and with one commit per record"""
+    results = {"records": records}
+    with tempfile.TemporaryDirectory() as path_dir:
+        path_db = os.path.join(path_dir, "attendance.db")
+        writer = AttendanceWriter(path_db)
+        when = datetime.datetime(2024, 1, 1, 9, 0, 0)
+        start = time.perf_counter()
+        for i in range(records):
+            writer.mark("person_%d" % i, "department", "position", when=when)
+        # Repeat sightings are answered from memory
+        repeat_start = time.perf_counter()
+        for i in range(records):
+            writer.mark("person_%d" % i, "department", "position", when=when)
+        repeat_seconds = time.perf_counter() - repeat_start
+        writer.close()
+        seconds = time.perf_counter() - start - repeat_seconds
+        results["writer_per_second"] = round(records / seconds, 1)
+        results["repeat_mark_us"] = round(repeat_seconds * 1e6 / records, 3)
+
+        conn = attendance_db.connect(path_db)
+        day = attendance_db.day_number("2024-01-02")
+        start = time.perf_counter()
+        for i in range(records):
+            conn.execute(attendance_db.UPSERT_PERSON, ("person_%d" % i, "department", "position"))
+            conn.execute(attendance_db.INSERT_ATTENDANCE, (day, 9 * 3600, "person_%d" % i))
+            conn.commit()
+        results["commit_per_record_per_second"] = round(records / (time.perf_counter() - start), 1)
+        conn.close()
+    return results
+
+
+def seed_attendance(conn, years=3, people=200, seed=0):
+    """One row per person and working day over `years`, return the dates"""
+    rng = np.random.default_rng(seed)
+    departments = ["Engineering", "Sales", "Finance", "Operations", "HR"]
+    first_day = datetime.date.today() - datetime.timedelta(days=365 * years)
+    dates = [first_day + datetime.timedelta(days=i) for i in range(365 * years)]
+    dates = [d.strftime('%Y-%m-%d') for d in dates if d.weekday() < 5]
+    conn.executemany(attendance_db.UPSERT_PERSON,
+                     [("person_%d" % i, departments[i % len(departments)], "Staff") for i in range(people)])
+    for date in dates:
+        present = rng.random(people) < 0.9
+        arrivals = rng.integers(7 * 3600, 10 * 3600, people)
+        day = attendance_db.day_number(date)
+        conn.executemany(attendance_db.INSERT_ATTENDANCE,
+                         [(day, int(arrivals[i]), "person_%d" % i) for i in range(people) if present[i]])
+    conn.commit()
+    return dates
+
+
+def bench_dashboard(years=3, people=200, n_queries=50, seed=0):
+    """Latency of the dashboard queries on a database seeded with years of attendance"""
+    results = {"years": years, "people": people}
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as path_dir:
+        path_db = os.path.join(path_dir, "attendance.db")
+        conn = attendance_db.connect(path_db)
+        start = time.perf_counter()
+        dates = seed_attendance(conn, years, people, seed)
+        results["seed_s"] = round(time.perf_counter() - start, 3)
+        results["rows"] = conn.execute("SELECT COUNT(*) FROM attendance").fetchone()[0]
+        # Move the seeded rows from the write-ahead log into the database file before measuring it
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        results["db_bytes"] = os.path.getsize(path_db)
+        for name, sql in DASHBOARD_QUERIES.items():
+            latencies = []
+            for date in rng.choice(dates, n_queries):
+                start = time.perf_counter()
+                conn.execute(sql, (attendance_db.day_number(str(date)),)).fetchall()
+                latencies.append(time.perf_counter() - start)
+            results[name] = percentiles(latencies)
+        conn.close()
+    return results
+
+
+def bench_startup(modules=ENTRY_MODULES, repeat=3, skip_models=False):
+    """Import time of every entry point in a fresh interpreter, and the load time of each model"""
+    path_repo = os.path.dirname(os.path.abspath(__file__))
+    results = {"import_ms": {}}
+    code = ("import time; start = time.perf_counter(); import {module}; "
+            "print((time.perf_counter() - start) * 1000)")
+    for module in modules:
+        timings = []
+        for _ in range(repeat):
+            completed = subprocess.run([sys.executable, "-c", code.format(module=module)], cwd=path_repo,
+                                       capture_output=True, text=True)
+            if completed.returncode != 0:
+                timings = None
+                logging.warning("Could not import %s: %s", module, completed.stderr.strip().splitlines()[-1:])
+                break
+            timings.append(float(completed.stdout.strip().splitlines()[-1]))
+        # The best of a few runs, the others include a cold disk cache
+        results["import_ms"][module] = round(min(timings), 1) if timings else None
+
+    if skip_models:
+        results["model_load_ms"] = {"skipped": "--skip-models"}
+        return results
+    import model_registry
+    results["model_load_ms"] = {}
+    for name in model_registry.MODELS:
+        try:
+            model_registry.get_model(name)
+            results["model_load_ms"][name] = round(model_registry.load_seconds[name] * 1000, 1)
+        except (ImportError, RuntimeError, OSError) as e:
+            results["model_load_ms"][name] = None
+            logging.warning("Could not load model %s: %s", name, e)
+    return results
+
+
+def run_benchmarks(sizes=GALLERY_SIZES, path_frames=None, skip_models=False, records=5000, years=3, people=200):
+    results = {"meta": {"timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                        "version": read_version(), "python": platform.python_version(),
+                        "numpy": np.__version__, "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()}}
+    logging.info("Startup")
+    results["startup"] = bench_startup(skip_models=skip_models)
+    logging.info("Gallery load and matching")
+    results["gallery"] = bench_gallery(sizes)
+    if skip_models:
+        results["recognition"] = {"skipped": "--skip-models"}
+    else:
+        logging.info("Detection and descriptors")
+        try:
+            frames = read_frames(path_frames) if path_frames else synthetic_frames()
+            results["recognition"] = bench_recognition(frames)
+            results["recognition"]["source"] = path_frames or "synthetic"
+        except (ImportError, RuntimeError) as e:
+            # dlib or its models are missing
+            logging.warning("Skipping detection and descriptors: %s", e)
+            results["recognition"] = {"skipped": str(e)}
+    logging.info("Attendance inserts")
+    results["attendance_inserts"] = bench_attendance_inserts(records)
+    logging.info("Dashboard queries")
+    results["dashboard"] = bench_dashboard(years, people)
+    return results
+
+
+def read_version():
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "version.json")) as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark the recognition and attendance hot paths")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(GALLERY_SIZES),
+                        help="Synthetic gallery sizes")
+    parser.add_argument("--frames", default=None,
+                        help="Video or folder of images for detection / descriptors, synthetic frames by default")
+    parser.add_argument("--skip-models", action="store_true", help="Skip the benchmarks that need the dlib models")
+    parser.add_argument("--records", type=int, default=5000, help="Attendance records to insert")
+    parser.add_argument("--years", type=int, default=3, help="Years of attendance in the dashboard database")
+    parser.add_argument("--people", type=int, default=200, help="People in the dashboard database")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.frames, args.skip_models, args.records, args.years, args.people)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info("Results written to %s", args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Persistent cache of 128D face descriptors for features_extraction_to_csv.py
+Descriptors are stored per image, keyed by path, size, mtime and a hash of the
+dlib models, and the mean of every person is stored with a signature of its
+images, so later runs only process new or changed images
+"""
+
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+PATH_DESCRIPTOR_CACHE = "data/descriptor_cache.db"
+
+# Part of the model key, bump when the way descriptors are computed changes
+# (e.g. detector upsampling), so old entries are not reused
+EXTRACTION_VERSION = "1"
+
+
+# Model hashes by the paths, sizes and mtimes of the files, a long-running process reads them once
+_model_hashes = {}
+
+
+def model_hash(*paths_model):
+    """SHA-1 of the model files, entries computed with other models never match"""
+    key = tuple((path_model, os.stat(path_model).st_size, os.stat(path_model).st_mtime_ns)
+                for path_model in paths_model)
+    if key not in _model_hashes:
+        sha1 = hashlib.sha1(EXTRACTION_VERSION.encode())
+        for path_model in paths_model:
+            with open(path_model, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha1.update(block)
+        _model_hashes[key] = sha1.hexdigest()
+    return _model_hashes[key]
+
+
+def image_stamp(path_img):
+    stat = os.stat(path_img)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def person_signature(images):
+    """Signature of a person folder from the (path, size, mtime) of its images"""
+    sha1 = hashlib.sha1()
+    for path_img, (size, mtime_ns) in sorted(images.items()):
+        sha1.update(("%s\0%d\0%d\n" % (path_img, size, mtime_ns)).encode("utf-8"))
+    return sha1.hexdigest()
+
+
+class DescriptorCache:
+    def __init__(self, models_key, path_cache=PATH_DESCRIPTOR_CACHE, refresh=False):
+        self.models_key = models_key
+        # Recompute everything but still store the results
+        self.refresh = refresh
+        self.conn = sqlite3.connect(path_cache)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS descriptors (path TEXT PRIMARY KEY, size INTEGER, "
+                          "mtime_ns INTEGER, model TEXT, descriptor BLOB, seconds REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS persons (folder TEXT PRIMARY KEY, signature TEXT, "
+                          "model TEXT, mean BLOB, seconds REAL)")
+
+        # Statistics of the current run
+        self.hits = 0
+        self.misses = 0
+        self.persons_reused = 0
+        self.seconds_saved = 0.0
+
+    def get(self, path_img, stamp):
+        """Cached descriptor of one image: (found, descriptor or None if no face)"""
+        row = self.conn.execute("SELECT size, mtime_ns, model, descriptor, seconds FROM descriptors WHERE path = ?",
+                                (path_img,)).fetchone()
+        if self.refresh or row is None or (row[0], row[1]) != stamp or row[2] != self.models_key:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.seconds_saved += row[4]
+        descriptor = np.frombuffer(row[3], dtype=np.float32) if row[3] is not None else None
+        return True, descriptor
+
+    def put(self, path_img, stamp, descriptor, seconds):
+        blob = np.asarray(descriptor, dtype=np.float32).tobytes() if descriptor is not None else None
+        self.conn.execute("INSERT OR REPLACE INTO descriptors VALUES (?, ?, ?, ?, ?, ?)",
+                          (path_img, stamp[0], stamp[1], self.models_key, blob, seconds))
+
+    def get_person(self, folder, signature, images_cnt):
+        """Cached mean of a person whose `images_cnt` images did not change, else None
+
+        A `signature` of None takes the cached mean as it is, without checking the images.
+        """
+        row = self.conn.execute("SELECT signature, model, mean, seconds FROM persons WHERE folder = ?",
+                                (folder,)).fetchone()
+        if (self.refresh or row is None or (signature is not None and row[0] != signature)
+                or row[1] != self.models_key):
+            return None
+        self.persons_reused += 1
+        self.hits += images_cnt
+        self.seconds_saved += row[3]
+        return np.frombuffer(row[2], dtype=np.float32)
+
+    def put_person(self, folder, signature, mean, paths_img):
+        # Recompute cost of the person is the time spent on each of its images
+        seconds = 0.0
+        for path_img in paths_img:
+            row = self.conn.execute("SELECT seconds FROM descriptors WHERE path = ?", (path_img,)).fetchone()
+            if row is not None:
+                seconds += row[0]
+        self.conn.execute("INSERT OR REPLACE INTO persons VALUES (?, ?, ?, ?, ?)",
+                          (folder, signature, self.models_key, np.asarray(mean, dtype=np.float32).tobytes(), seconds))
+        self.conn.commit()
+
+    def prune(self, paths_img, folders):
+        """Drop entries of images and persons that no longer exist"""
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS live_paths (path TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM live_paths")
+        self.conn.executemany("INSERT OR IGNORE INTO live_paths VALUES (?)", [(p,) for p in paths_img])
+        self.conn.execute("DELETE FROM descriptors WHERE path NOT IN (SELECT path FROM live_paths)")
+        self.conn.execute("DELETE FROM live_paths")
+        self.conn.executemany("INSERT OR IGNORE INTO live_paths VALUES (?)", [(f,) for f in folders])
+        self.conn.execute("DELETE FROM persons WHERE folder NOT IN (SELECT path FROM live_paths)")
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
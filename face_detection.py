@@ -0,0 +1,104 @@
+"""
+Downscaled, grayscale face detection for Face Recognition Attendance System
+HOG cost grows with the number of pixels, so faces are detected on a smaller
+grayscale copy of the frame and the rectangles are mapped back to full
+resolution for landmarks and descriptors
+"""
+
+import argparse
+import logging
+import time
+
+import cv2
+
+from model_registry import get_detector
+
+# dlib's frontal face detector finds faces down to about 80x80 pixels without upsampling
+HOG_MIN_FACE_SIZE = 80
+
+
+def scale_for_min_face_size(min_face_size):
+    """Smallest scale at which faces of `min_face_size` pixels are still detected"""
+    return min(1.0, HOG_MIN_FACE_SIZE / float(min_face_size))
+
+
+class ScaledDetector:
+    def __init__(self, detector=None, scale=1.0, grayscale=True, min_face_size=None, color="bgr"):
+        # None: dlib's frontal face detector from the model registry, loaded on the first frame
+        self.detector = detector
+        # The scale is picked automatically when the smallest face to detect is given
+        self.scale = scale_for_min_face_size(min_face_size) if min_face_size else scale
+        self.grayscale = grayscale
+        # Channel order of the frames: "bgr" from cv2.VideoCapture, "rgb" in the registration GUI
+        self.color = color
+
+    def prepare(self, img):
+        """Image the detector runs on: grayscale and / or resized"""
+        if self.grayscale and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY if self.color == "bgr" else cv2.COLOR_RGB2GRAY)
+        if self.scale != 1.0:
+            img = cv2.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return img
+
+    def __call__(self, img, upsample_num_times=0):
+        """Faces in `img`, as rectangles in the coordinates of `img`"""
+        if self.detector is None:
+            self.detector = get_detector()
+        faces = self.detector(self.prepare(img), upsample_num_times)
+        if self.scale == 1.0:
+            return faces
+        import dlib
+        rects = dlib.rectangles()
+        for d in faces:
+            rects.append(dlib.rectangle(int(round(d.left() / self.scale)), int(round(d.top() / self.scale)),
+                                        int(round(d.right() / self.scale)), int(round(d.bottom() / self.scale))))
+        return rects
+
+
+def benchmark(path_video, scales=(1.0, 0.75, 0.5, 0.25), grayscale_modes=(False, True), max_frames=300):
+    """Fps, CPU use and faces found by the detector at each scale on a recorded clip"""
+    detector = get_detector()
+    results = []
+    for grayscale in grayscale_modes:
+        for scale in scales:
+            scaled_detector = ScaledDetector(detector, scale=scale, grayscale=grayscale)
+            stream = cv2.VideoCapture(path_video)
+            frame_cnt = 0
+            faces_cnt = 0
+            wall_seconds = 0.0
+            cpu_seconds = 0.0
+            while frame_cnt < max_frames:
+                flag, img_rd = stream.read()
+                if not flag:
+                    break
+                wall_start, cpu_start = time.perf_counter(), time.process_time()
+                faces_cnt += len(scaled_detector(img_rd))
+                wall_seconds += time.perf_counter() - wall_start
+                cpu_seconds += time.process_time() - cpu_start
+                frame_cnt += 1
+            stream.release()
+            if not frame_cnt:
+                raise ValueError("No frames could be read from %s" % path_video)
+            results.append({"scale": scale, "grayscale": grayscale, "frames": frame_cnt,
+                            "fps": frame_cnt / wall_seconds if wall_seconds else 0.0,
+                            "cpu_ms_per_frame": cpu_seconds * 1000 / frame_cnt,
+                            "faces_per_frame": faces_cnt / frame_cnt})
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Measure face detection fps and CPU at several scales")
+    parser.add_argument("video", help="Recorded clip to run the detector on")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1.0, 0.75, 0.5, 0.25])
+    parser.add_argument("--frames", type=int, default=300, help="Frames to process per setting")
+    args = parser.parse_args()
+
+    for result in benchmark(args.video, args.scales, max_frames=args.frames):
+        logging.info("scale %.2f %-5s  %7.1f fps  %7.1f ms CPU/frame  %.2f faces/frame",
+                     result["scale"], "gray" if result["grayscale"] else "color", result["fps"],
+                     result["cpu_ms_per_frame"], result["faces_per_frame"])
+
+
+if __name__ == '__main__':
+    main()
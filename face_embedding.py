@@ -0,0 +1,43 @@
+"""
+Batched 128D face descriptors shared by attendance_taker.py and features_extraction_to_csv.py
+dlib's ResNet accepts every face of an image, or a list of images, in one call;
+that amortizes the per-call overhead over group photos and enrollment chunks
+"""
+
+import numpy as np
+
+from face_gallery import descriptor_matrix, DESCRIPTOR_SIZE
+
+
+def face_landmarks(predictor, img, faces):
+    """68-point shapes of `faces` in `img`, as one dlib.full_object_detections"""
+    import dlib
+    shapes = dlib.full_object_detections()
+    for face in faces:
+        shapes.append(predictor(img, face))
+    return shapes
+
+
+def compute_descriptors(face_reco_model, img, shapes):
+    """Descriptors of all faces of one image in one call, (N, 128) float32"""
+    if len(shapes) == 0:
+        return np.empty((0, DESCRIPTOR_SIZE), dtype=np.float32)
+    return descriptor_matrix(face_reco_model.compute_face_descriptor(img, shapes))
+
+
+def compute_descriptors_batch(face_reco_model, imgs, shapes_list):
+    """Descriptors of the faces of several images in one call
+
+    `shapes_list[i]` holds the shapes found in `imgs[i]`; returns one (N_i, 128)
+    float32 matrix per image, in order.
+    """
+    batch = [(img, shapes) for img, shapes in zip(imgs, shapes_list) if len(shapes)]
+    results = iter(face_reco_model.compute_face_descriptor([img for img, _ in batch],
+                                                          [shapes for _, shapes in batch])) if batch else iter(())
+    return [descriptor_matrix(next(results)) if len(shapes) else np.empty((0, DESCRIPTOR_SIZE), dtype=np.float32)
+            for shapes in shapes_list]
+
+
+def embed_faces(predictor, face_reco_model, img, faces):
+    """Landmarks and descriptors of every face of one frame, (N, 128) float32"""
+    return compute_descriptors(face_reco_model, img, face_landmarks(predictor, img, faces))
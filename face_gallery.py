@@ -0,0 +1,370 @@
+"""
+Face gallery for Face Recognition Attendance System
+Holds the known 128D descriptors as one contiguous float32 matrix so that all
+faces of a frame can be matched against all people in a single operation
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+
+# Length of dlib face descriptors
+DESCRIPTOR_SIZE = 128
+
+# Binary gallery: metadata sidecar naming its float32 matrix "features_all.<generation>.npy"
+PATH_GALLERY = "data/features_all.json"
+# Legacy gallery written by older versions of features_extraction_to_csv.py
+PATH_FEATURES_CSV = "data/features_all.csv"
+
+# Bump when the layout of the binary gallery changes; version 1 sidecars are still read
+GALLERY_FORMAT_VERSION = 2
+
+# Maximum e-distance accepted as the same person
+DISTANCE_THRESHOLD = 0.4
+
+
+def descriptor_matrix(descriptors):
+    """Stack dlib descriptors / lists / arrays into a (N, 128) float32 matrix"""
+    if isinstance(descriptors, np.ndarray):
+        matrix = descriptors.astype(np.float32, copy=False)
+    else:
+        descriptors = list(descriptors)
+        if not descriptors:
+            return np.empty((0, DESCRIPTOR_SIZE), dtype=np.float32)
+        matrix = np.asarray([np.asarray(d, dtype=np.float32) for d in descriptors], dtype=np.float32)
+    return np.ascontiguousarray(matrix.reshape(-1, DESCRIPTOR_SIZE))
+
+
+class FaceGallery:
+    def __init__(self, features, names=None, departments=None, positions=None, norms=None):
+        features = np.asarray(features, dtype=np.float32).reshape(-1, DESCRIPTOR_SIZE)
+        # Empty cells in the features file are read as NaN, treat them as 0 like before;
+        # saved galleries never contain NaN and come with their norms, nothing to scan then
+        if norms is None and np.isnan(features).any():
+            features = np.nan_to_num(features)
+        self.features = np.ascontiguousarray(features)
+        count = self.features.shape[0]
+
+        self.names = list(names) if names is not None else [""] * count
+        self.departments = list(departments) if departments is not None else [""] * count
+        self.positions = list(positions) if positions is not None else [""] * count
+
+        # Squared norms of every row, so ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+        if norms is None:
+            norms = np.einsum('ij,ij->i', self.features, self.features)
+        self.norms = np.asarray(norms, dtype=np.float32)
+        # People whose images had no face detected are saved as all-zero rows
+        self.valid = self.norms > 0
+        # Optional approximate index for large galleries, see face_index.py
+        self.index = None
+        # Incremented on every save of the binary gallery, 0 when not read from one
+        self.generation = 0
+        self.saved_at = None
+        # CRC32 of the features from the sidecar, None when not read from one
+        self.checksum = None
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def person(self, index):
+        """Return (name, department, position) of person `index`"""
+        return self.names[index], self.departments[index], self.positions[index]
+
+    def squared_distances(self, descriptors):
+        """Squared e-distances between every descriptor and every person, (M, N)"""
+        queries = descriptor_matrix(descriptors)
+        query_norms = np.einsum('ij,ij->i', queries, queries)
+        dist = query_norms[:, None] + self.norms[None, :]
+        dist -= 2.0 * (queries @ self.features.T)
+        np.maximum(dist, 0, out=dist)
+        dist[:, ~self.valid] = np.inf
+        return dist
+
+    def match(self, descriptors, k=1):
+        """Return (ids, distances) of the k closest people for every descriptor, both (M, k)
+
+        Rows are sorted by distance; invalid people have an infinite distance.
+        With an index attached only its shortlist is scanned, exact e-distances
+        are still returned for it.
+        """
+        queries = descriptor_matrix(descriptors)
+        k = min(k, len(self))
+        if queries.shape[0] == 0 or k <= 0:
+            return (np.empty((queries.shape[0], 0), dtype=np.int64),
+                    np.empty((queries.shape[0], 0), dtype=np.float32))
+        if self.index is not None:
+            return self.index.search(self, queries, k)
+
+        dist = self.squared_distances(queries)
+        if k < dist.shape[1]:
+            ids = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            ids = np.tile(np.arange(dist.shape[1]), (dist.shape[0], 1))
+        top = np.take_along_axis(dist, ids, axis=1)
+        order = np.argsort(top, axis=1)
+        ids = np.take_along_axis(ids, order, axis=1).astype(np.int64)
+        return ids, np.sqrt(np.take_along_axis(top, order, axis=1))
+
+    def identify(self, descriptors, threshold=DISTANCE_THRESHOLD):
+        """Return (ids, distances) of the best match per descriptor, id -1 if above `threshold`"""
+        ids, dist = self.match(descriptors, k=1)
+        if ids.shape[1] == 0:
+            count = ids.shape[0]
+            return np.full(count, -1, dtype=np.int64), np.full(count, np.inf, dtype=np.float32)
+        ids, dist = ids[:, 0], dist[:, 0]
+        return np.where(dist < threshold, ids, -1), dist
+
+
+def load_gallery_csv(path_features):
+    """Read "features_all.csv" (name, department, position, 128 features per row)"""
+    names, departments, positions, features = [], [], [], []
+    with open(path_features, newline="") as csvfile:
+        for row in csv.reader(csvfile):
+            if not row:
+                continue
+            names.append(row[0])
+            departments.append(row[1])
+            positions.append(row[2])
+            features.append([float(value) if value else 0.0 for value in row[3:3 + DESCRIPTOR_SIZE]])
+    return FaceGallery(features, names, departments, positions)
+
+
+def matrix_path_for(path_gallery, generation):
+    """Path of the float32 matrix of a given gallery generation"""
+    return "%s.%d.npy" % (os.path.splitext(path_gallery)[0], generation)
+
+
+def norms_path_for(path_gallery, generation):
+    """Path of the squared row norms saved with the matrix of a generation"""
+    return "%s.%d.norms.npy" % (os.path.splitext(path_gallery)[0], generation)
+
+
+def read_gallery_header(path_gallery=PATH_GALLERY):
+    with open(path_gallery, encoding="utf-8") as f:
+        header = json.load(f)
+    if header.get("format_version") not in (1, GALLERY_FORMAT_VERSION):
+        raise ValueError("Unsupported gallery format version %s in %s"
+                         % (header.get("format_version"), path_gallery))
+    return header
+
+
+def save_gallery(gallery, path_gallery=PATH_GALLERY):
+    """Write `gallery` as a float32 .npy matrix plus the JSON metadata sidecar
+
+    Every save writes a new matrix file for the next generation, then moves
+    the sidecar into place as the commit point, so readers always see a
+    complete gallery and a matrix that is still mapped is never overwritten.
+    """
+    features = np.ascontiguousarray(gallery.features, dtype=np.float32)
+    generation = 0
+    try:
+        generation = int(read_gallery_header(path_gallery).get("generation", 0))
+    except (OSError, ValueError):
+        pass
+    generation += 1
+    path_matrix = matrix_path_for(path_gallery, generation)
+    path_norms = norms_path_for(path_gallery, generation)
+    norms = np.einsum('ij,ij->i', features, features)
+
+    header = {
+        "format_version": GALLERY_FORMAT_VERSION,
+        "generation": generation,
+        "saved_at": time.time(),
+        "matrix": os.path.basename(path_matrix),
+        "norms": os.path.basename(path_norms),
+        "count": int(features.shape[0]),
+        "dim": DESCRIPTOR_SIZE,
+        "checksum": zlib.crc32(features.tobytes()) & 0xffffffff,
+        # Parallel lists parse several times faster than one object per person
+        "names": [str(name) for name in gallery.names],
+        "departments": [str(department) for department in gallery.departments],
+        "positions": [str(position) for position in gallery.positions],
+    }
+
+    with open(path_matrix + ".tmp", "wb") as f:
+        np.save(f, features)
+    os.replace(path_matrix + ".tmp", path_matrix)
+    with open(path_norms + ".tmp", "wb") as f:
+        np.save(f, norms)
+    os.replace(path_norms + ".tmp", path_norms)
+    with open(path_gallery + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False)
+    os.replace(path_gallery + ".tmp", path_gallery)
+
+    # Keep the previous matrix for readers that have not switched yet
+    for old_generation in range(generation - 2, 0, -1):
+        path_old = matrix_path_for(path_gallery, old_generation)
+        if not os.path.exists(path_old):
+            break
+        for path in (path_old, norms_path_for(path_gallery, old_generation)):
+            try:
+                os.remove(path)
+            except OSError:
+                # Still mapped by a running recognizer (Windows), removed on a later save
+                pass
+    return header
+
+
+def load_gallery(path_gallery=PATH_GALLERY, verify=False):
+    """Memory-map a binary gallery written by save_gallery
+
+    Raises ValueError if the format version is unknown or the matrix does not
+    match its sidecar; `verify` also compares the checksum of the matrix.
+    Without `verify` the matrix is only mapped, not read: the norms and the
+    valid rows come from the norms file saved with it.
+    """
+    header = read_gallery_header(path_gallery)
+    path_matrix = os.path.join(os.path.dirname(path_gallery), header["matrix"])
+    features = np.load(path_matrix, mmap_mode="r")
+    if features.dtype != np.float32 or features.shape != (header["count"], header["dim"]):
+        raise ValueError("Gallery matrix %s does not match its sidecar" % path_matrix)
+    if verify and zlib.crc32(features.tobytes()) & 0xffffffff != header["checksum"]:
+        raise ValueError("Gallery matrix %s does not match its checksum" % path_matrix)
+
+    norms = None
+    if header.get("norms"):
+        norms = np.load(os.path.join(os.path.dirname(path_gallery), header["norms"]))
+        if norms.shape != (header["count"],):
+            raise ValueError("Gallery norms %s do not match the sidecar" % header["norms"])
+    else:
+        # Saved before the norms were, computed from the matrix once
+        norms = np.einsum('ij,ij->i', features, features)
+
+    if "people" in header:
+        # Version 1 sidecar
+        people = header["people"]
+        header["names"] = [person["name"] for person in people]
+        header["departments"] = [person["department"] for person in people]
+        header["positions"] = [person["position"] for person in people]
+    gallery = FaceGallery(features, header["names"], header["departments"], header["positions"], norms=norms)
+    gallery.generation = header.get("generation", 0)
+    gallery.saved_at = header.get("saved_at")
+    gallery.checksum = header.get("checksum")
+    return gallery
+
+
+class GalleryWatcher:
+    """Reload the binary gallery in the background when its sidecar changes
+
+    The new gallery is loaded, checked and prepared (e.g. indexed) on a worker
+    thread; the recognizer picks it up with take() between two frames, so
+    recognition never waits for the load or sees a half-written gallery.
+    """
+
+    def __init__(self, path_gallery=PATH_GALLERY, prepare=None, interval=1.0, retries=5):
+        self.path_gallery = path_gallery
+        # Called with (gallery, path_gallery) on the worker thread before handing it over
+        self.prepare = prepare
+        self.interval = interval
+        self.retries = retries
+
+        self.generation = 0
+        # Unchanged (mtime, size) of the sidecar means nothing to reload
+        self._stamp = self._sidecar_stamp()
+        self._pending = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sidecar_stamp(self):
+        try:
+            stat = os.stat(self.path_gallery)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self, generation=0):
+        self.generation = generation
+        self._thread = threading.Thread(target=self._watch, name="GalleryWatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def take(self):
+        """Return the newly loaded gallery once, None if there is nothing new"""
+        with self._lock:
+            gallery, self._pending = self._pending, None
+        return gallery
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            stamp = self._sidecar_stamp()
+            if stamp is None or stamp == self._stamp:
+                continue
+            self._stamp = stamp
+            gallery = self._load()
+            if gallery is not None and gallery.generation != self.generation:
+                self.generation = gallery.generation
+                with self._lock:
+                    self._pending = gallery
+
+    def _load(self):
+        start = time.time()
+        for attempt in range(self.retries):
+            try:
+                gallery = load_gallery(self.path_gallery, verify=True)
+                break
+            except (OSError, ValueError, KeyError) as e:
+                # The matrix may be replaced while we read it, try again shortly
+                logging.debug("Gallery reload attempt %d failed: %s", attempt + 1, e)
+                time.sleep(self.interval / 4)
+        else:
+            logging.warning("Could not reload '%s', keeping the current gallery", self.path_gallery)
+            return None
+
+        if self.prepare is not None:
+            try:
+                self.prepare(gallery, self.path_gallery)
+            except Exception:
+                # The watcher keeps running, the next save is picked up again
+                logging.exception("Could not prepare '%s', keeping the current gallery", self.path_gallery)
+                return None
+        logging.info("Gallery generation %d loaded in background: %d faces in %.1f ms, %.2f s after save",
+                     gallery.generation, len(gallery), (time.time() - start) * 1000,
+                     time.time() - gallery.saved_at if gallery.saved_at else float("nan"))
+        return gallery
+
+
+def convert_csv_to_gallery(path_features_csv=PATH_FEATURES_CSV, path_gallery=PATH_GALLERY):
+    """One-shot conversion of a legacy "features_all.csv" into the binary gallery"""
+    gallery = load_gallery_csv(path_features_csv)
+    save_gallery(gallery, path_gallery)
+    return gallery
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Manage the binary face gallery")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_convert = subparsers.add_parser("convert", help="Convert features_all.csv into the binary gallery")
+    parser_convert.add_argument("csv", nargs="?", default=PATH_FEATURES_CSV)
+    parser_convert.add_argument("gallery", nargs="?", default=PATH_GALLERY)
+
+    parser_info = subparsers.add_parser("info", help="Load a binary gallery and print its size")
+    parser_info.add_argument("gallery", nargs="?", default=PATH_GALLERY)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        gallery = convert_csv_to_gallery(args.csv, args.gallery)
+        logging.info("Converted %d faces from %s into: %s", len(gallery), args.csv, args.gallery)
+    else:
+        start = time.perf_counter()
+        gallery = load_gallery(args.gallery, verify=True)
+        logging.info("%d faces (%d valid) loaded from %s in %.1f ms",
+                     len(gallery), int(gallery.valid.sum()), args.gallery, (time.perf_counter() - start) * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Approximate nearest-neighbour index for large face galleries
+An inverted-file (IVF) index on NumPy: people are clustered with k-means and a
+query only scans the people of its closest clusters, then the shortlist is
+re-ranked with exact e-distances so the acceptance threshold is unchanged
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+import zipfile
+import zlib
+
+import numpy as np
+
+from face_gallery import FaceGallery, descriptor_matrix, load_gallery, load_gallery_csv, \
+    DESCRIPTOR_SIZE, PATH_GALLERY
+
+# Galleries up to this size are always searched exactly
+EXACT_SEARCH_LIMIT = 20000
+
+# Bump when the layout of the saved index changes
+INDEX_FORMAT_VERSION = 1
+
+# Rows per chunk when assigning people to clusters, bounds memory on 1M galleries
+ASSIGN_CHUNK = 65536
+
+
+def index_path_for(path_features):
+    """Path of the index persisted next to the features file"""
+    return os.path.splitext(path_features)[0] + ".ivf.npz"
+
+
+def gallery_fingerprint(gallery):
+    """Checksum of the gallery features, used to detect a stale index"""
+    if gallery.checksum is not None:
+        # Saved in the sidecar, the mapped matrix does not have to be read
+        return gallery.checksum
+    return zlib.crc32(gallery.features.tobytes()) & 0xffffffff
+
+
+def _nearest_centroids(points, centroids):
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    labels = np.empty(points.shape[0], dtype=np.int32)
+    for start in range(0, points.shape[0], ASSIGN_CHUNK):
+        chunk = points[start:start + ASSIGN_CHUNK]
+        # ||x||^2 is the same for every centroid, so it can be left out
+        dist = centroid_norms[None, :] - 2.0 * (chunk @ centroids.T)
+        labels[start:start + ASSIGN_CHUNK] = np.argmin(dist, axis=1)
+    return labels
+
+
+def train_centroids(points, n_lists, n_iter=10, seed=0):
+    """Lloyd's k-means on (a sample of) `points`, returns (n_lists, 128) float32 centroids"""
+    rng = np.random.default_rng(seed)
+    # 256 points per list is plenty to place the centroids
+    sample_size = min(points.shape[0], n_lists * 256)
+    sample = points[rng.choice(points.shape[0], sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+    for _ in range(n_iter):
+        labels = _nearest_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=n_lists)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty lists with random points so no list stays unused
+        empty = np.flatnonzero(~filled)
+        if empty.size:
+            centroids[empty] = sample[rng.choice(sample_size, empty.size, replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    def __init__(self, centroids, list_ids, list_offsets, fingerprint=0, n_probe=16):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        # Constant per index, not recomputed per query
+        self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        # Person ids grouped by list, list i is list_ids[list_offsets[i]:list_offsets[i + 1]]
+        self.list_ids = np.ascontiguousarray(list_ids, dtype=np.int64)
+        self.list_offsets = np.ascontiguousarray(list_offsets, dtype=np.int64)
+        self.fingerprint = fingerprint
+        self.n_probe = n_probe
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, gallery, n_lists=None, n_probe=16, n_iter=10):
+        """Cluster the valid people of `gallery` into `n_lists` inverted lists"""
+        ids = np.flatnonzero(gallery.valid)
+        points = gallery.features[ids]
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(max(len(ids), 1)))
+        n_lists = max(1, min(n_lists, len(ids)))
+
+        start = time.time()
+        centroids = train_centroids(points, n_lists, n_iter=n_iter)
+        labels = _nearest_centroids(points, centroids)
+        order = np.argsort(labels, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+        logging.info("IVF index with %d lists built for %d faces in %.2f s",
+                     n_lists, len(ids), time.time() - start)
+        return cls(centroids, ids[order], offsets, gallery_fingerprint(gallery), n_probe)
+
+    def save(self, path):
+        # Write under a temporary name first so readers never see a partial index; the name is unique
+        # because several processes may build the same index at once
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp.npz", prefix=os.path.basename(path) + ".",
+                                        dir=os.path.dirname(path) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, version=INDEX_FORMAT_VERSION, centroids=self.centroids,
+                         list_ids=self.list_ids, list_offsets=self.list_offsets,
+                         fingerprint=np.uint32(self.fingerprint), n_probe=self.n_probe)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != INDEX_FORMAT_VERSION:
+                raise ValueError("Unsupported index version %d in %s" % (int(data['version']), path))
+            return cls(data['centroids'], data['list_ids'], data['list_offsets'],
+                       int(data['fingerprint']), int(data['n_probe']))
+
+    def probe_lists(self, queries):
+        """(N, n_probe) lists closest to each query, all queries scored in one matrix product"""
+        dist = self.centroid_norms[None, :] - 2.0 * (queries @ self.centroids.T)
+        n_probe = min(self.n_probe, self.n_lists)
+        if n_probe == self.n_lists:
+            return np.broadcast_to(np.arange(n_probe), (queries.shape[0], n_probe))
+        return np.argpartition(dist, n_probe - 1, axis=1)[:, :n_probe]
+
+    def candidates(self, probe):
+        """Ids of the people in the lists `probe`"""
+        return np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probe])
+
+    def search(self, gallery, descriptors, k=1):
+        """Same contract as FaceGallery.match, exact e-distances on the shortlist"""
+        queries = descriptor_matrix(descriptors)
+        ids = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        distances = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        probes = self.probe_lists(queries)
+        for row, query in enumerate(queries):
+            shortlist = self.candidates(probes[row])
+            if shortlist.size == 0:
+                continue
+            diff = gallery.features[shortlist] - query
+            dist = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+            top = np.argsort(dist)[:k]
+            ids[row, :top.size] = shortlist[top]
+            distances[row, :top.size] = dist[top]
+        return ids, distances
+
+
+def load_or_build_index(gallery, path_features, n_probe=None):
+    """Attach an IVF index to `gallery` when it is too large for exact search
+
+    The index is loaded from next to the features file if it still matches the
+    gallery, otherwise it is rebuilt and saved there.
+    """
+    if len(gallery) <= EXACT_SEARCH_LIMIT:
+        gallery.index = None
+        return None
+
+    path_index = index_path_for(path_features)
+    fingerprint = gallery_fingerprint(gallery)
+    index = None
+    if os.path.exists(path_index):
+        try:
+            index = IVFIndex.load(path_index)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            # Truncated or corrupt, rebuilt like a stale one
+            logging.warning("Could not load index %s: %s", path_index, e)
+        if index is not None and index.fingerprint != fingerprint:
+            logging.info("Index %s is stale, rebuilding", path_index)
+            index = None
+    if index is None:
+        index = IVFIndex.build(gallery)
+        try:
+            index.save(path_index)
+        except OSError as e:
+            logging.warning("Could not save index %s: %s", path_index, e)
+    if n_probe is not None:
+        index.n_probe = n_probe
+    gallery.index = index
+    return index
+
+
+def random_gallery(size, seed=0):
+    """Synthetic gallery of `size` random unit vectors"""
+    rng = np.random.default_rng(seed)
+    features = rng.standard_normal((size, DESCRIPTOR_SIZE), dtype=np.float32)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    return FaceGallery(features)
+
+
+def benchmark(size=100000, n_queries=200, n_probe_list=(1, 4, 8, 16, 32), noise=0.05, seed=0):
+    """Recall@1 and per-query latency of the IVF index against exact search"""
+    gallery = random_gallery(size, seed)
+    rng = np.random.default_rng(seed + 1)
+    targets = rng.choice(size, n_queries, replace=False)
+    queries = gallery.features[targets] + noise * rng.standard_normal((n_queries, DESCRIPTOR_SIZE),
+                                                                      dtype=np.float32)
+
+    start = time.perf_counter()
+    exact_ids = np.concatenate([gallery.match(query[None, :], k=1)[0] for query in queries])[:, 0]
+    exact_ms = (time.perf_counter() - start) * 1000 / n_queries
+
+    start = time.perf_counter()
+    index = IVFIndex.build(gallery)
+    build_s = time.perf_counter() - start
+
+    results = {"size": size, "queries": n_queries, "n_lists": index.n_lists,
+               "build_s": round(build_s, 3), "exact_ms": round(exact_ms, 4), "ivf": []}
+    for n_probe in n_probe_list:
+        index.n_probe = n_probe
+        start = time.perf_counter()
+        ann_ids = index.search(gallery, queries, k=1)[0][:, 0]
+        ann_ms = (time.perf_counter() - start) * 1000 / n_queries
+        results["ivf"].append({"n_probe": n_probe, "ms": round(ann_ms, 4),
+                               "recall": float(np.mean(ann_ids == exact_ids)),
+                               "speedup": round(exact_ms / ann_ms, 2) if ann_ms else None})
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build or benchmark the IVF face index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_build = subparsers.add_parser("build", help="Build the index next to a features file")
+    parser_build.add_argument("features", nargs="?", default=PATH_GALLERY)
+
+    parser_bench = subparsers.add_parser("benchmark", help="Recall / latency against exact search")
+    parser_bench.add_argument("--size", type=int, nargs="+", default=[10000, 100000])
+    parser_bench.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if args.features.endswith(".csv"):
+            gallery = load_gallery_csv(args.features)
+        else:
+            gallery = load_gallery(args.features)
+        index = IVFIndex.build(gallery)
+        index.save(index_path_for(args.features))
+        logging.info("Index saved into: %s", index_path_for(args.features))
+    else:
+        for size in args.size:
+            result = benchmark(size, args.queries)
+            logging.info("%d faces, %d lists, build %.2f s, exact %.3f ms/query",
+                         result["size"], result["n_lists"], result["build_s"], result["exact_ms"])
+            for row in result["ivf"]:
+                logging.info("  n_probe %-3d %8.3f ms/query  recall@1 %.3f  speedup x%s",
+                             row["n_probe"], row["ms"], row["recall"], row["speedup"])
+
+
+if __name__ == '__main__':
+    main()
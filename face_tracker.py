@@ -0,0 +1,167 @@
+"""
+Multi-face tracker for Face Recognition Attendance System
+Faces keep a stable track ID across frames, whatever happens to the number of
+faces, so a recognized face is never embedded again while it stays in view
+"""
+
+import itertools
+
+import numpy as np
+
+
+class Track:
+    def __init__(self, track_id, rect):
+        self.id = track_id
+        self.rect = rect
+        self.box = rect_to_box(rect)
+        # None until the first recognition, then a known name or "unknown"
+        self.name = None
+        self.person_id = -1
+        # Frames since the face was last detected
+        self.missed = 0
+        # Frames the face has been detected in
+        self.hits = 1
+        # Set while a recognition job for the track is in flight (pipelined mode)
+        self.pending = False
+        # Frame of the last recognition attempt
+        self.checked_frame = 0
+        # Unknown faces are tried again at 'next_check_frame', with an exponential backoff
+        self.attempts = 0
+        self.next_check_frame = 0
+        # Best few e-distances seen for each candidate person, {person_id: [distance, ...]}
+        self.distances = {}
+
+    @property
+    def centroid(self):
+        return (self.box[:2] + self.box[2:]) / 2
+
+    def update(self, rect):
+        self.rect = rect
+        self.box = rect_to_box(rect)
+        self.missed = 0
+        self.hits += 1
+
+    def needs_recognition(self, frame_cnt):
+        """New faces, and unknown faces whose backoff expired; confirmed identities are never embedded again"""
+        if self.pending:
+            return False
+        return self.name is None or (self.name == "unknown" and frame_cnt >= self.next_check_frame)
+
+    def add_matches(self, person_ids, distances, best_few=3):
+        """Record the candidates of one recognition attempt, keeping the best few distances per person"""
+        for person_id, distance in zip(person_ids, distances):
+            if person_id < 0 or not np.isfinite(distance):
+                continue
+            best = self.distances.setdefault(int(person_id), [])
+            best.append(float(distance))
+            best.sort()
+            del best[best_few:]
+
+    def best_match(self):
+        """(person_id, mean of its best few distances) of the closest candidate, (-1, inf) if none"""
+        if not self.distances:
+            return -1, float("inf")
+        person_id = min(self.distances, key=lambda k: sum(self.distances[k]) / len(self.distances[k]))
+        return person_id, sum(self.distances[person_id]) / len(self.distances[person_id])
+
+    def forget(self):
+        """Drop the identity and the candidates of the track, it is recognized again"""
+        # A job in flight may be dropped, the track must not wait for its result
+        self.pending = False
+        self.name = None
+        self.person_id = -1
+        self.attempts = 0
+        self.next_check_frame = 0
+        self.distances = {}
+
+    def schedule_retry(self, frame_cnt, base_interval, max_interval):
+        """Try an unknown face again after base_interval, 2 * base_interval, ... frames"""
+        self.attempts += 1
+        self.next_check_frame = frame_cnt + min(base_interval * 2 ** (self.attempts - 1), max_interval)
+
+
+def rect_to_box(rect):
+    return np.array([rect.left(), rect.top(), rect.right(), rect.bottom()], dtype=np.float32)
+
+
+def iou_matrix(boxes_1, boxes_2):
+    """Intersection over union of every pair of (left, top, right, bottom) boxes, (N, M)"""
+    boxes_1 = boxes_1.reshape(-1, 1, 4)
+    boxes_2 = boxes_2.reshape(1, -1, 4)
+    width = np.clip(np.minimum(boxes_1[..., 2], boxes_2[..., 2]) - np.maximum(boxes_1[..., 0], boxes_2[..., 0]),
+                    0, None)
+    height = np.clip(np.minimum(boxes_1[..., 3], boxes_2[..., 3]) - np.maximum(boxes_1[..., 1], boxes_2[..., 1]),
+                     0, None)
+    intersection = width * height
+    area_1 = (boxes_1[..., 2] - boxes_1[..., 0]) * (boxes_1[..., 3] - boxes_1[..., 1])
+    area_2 = (boxes_2[..., 2] - boxes_2[..., 0]) * (boxes_2[..., 3] - boxes_2[..., 1])
+    return intersection / np.maximum(area_1 + area_2 - intersection, 1e-6)
+
+
+def greedy_assignment(score, threshold):
+    """Pairs (i, j) with the highest scores first, each row and column used once, score > threshold"""
+    pairs = []
+    used_rows = set()
+    used_cols = set()
+    for i, j in zip(*np.unravel_index(np.argsort(-score, axis=None), score.shape)):
+        if score[i, j] <= threshold:
+            break
+        if i not in used_rows and j not in used_cols:
+            pairs.append((int(i), int(j)))
+            used_rows.add(i)
+            used_cols.add(j)
+    return pairs
+
+
+class FaceTracker:
+    def __init__(self, iou_threshold=0.3, max_missed=5):
+        # Minimum overlap between a face and the last box of a track to continue it
+        self.iou_threshold = iou_threshold
+        # A track is dropped after 'max_missed' frames without a matching face
+        self.max_missed = max_missed
+        self.tracks = []
+        self.track_ids = itertools.count(1)
+
+    def update(self, faces):
+        """Assign the faces of a new frame to tracks, return one track per face, in order
+
+        Faces are first matched by IoU; faces that moved too fast to overlap are
+        matched by centroid distance, relative to the face width. Unmatched faces
+        start new tracks (name None); unmatched tracks age out after max_missed.
+        """
+        boxes = np.array([rect_to_box(d) for d in faces], dtype=np.float32).reshape(-1, 4)
+        last_boxes = np.array([track.box for track in self.tracks], dtype=np.float32).reshape(-1, 4)
+        assigned = [None] * len(faces)
+
+        pairs = greedy_assignment(iou_matrix(boxes, last_boxes), self.iou_threshold)
+        free_faces = [i for i in range(len(faces)) if i not in {i for i, _ in pairs}]
+        free_tracks = [j for j in range(len(self.tracks)) if j not in {j for _, j in pairs}]
+        if free_faces and free_tracks:
+            centroids = (boxes[free_faces, :2] + boxes[free_faces, 2:]) / 2
+            last_centroids = (last_boxes[free_tracks, :2] + last_boxes[free_tracks, 2:]) / 2
+            widths = boxes[free_faces, 2] - boxes[free_faces, 0]
+            # 1 when the centroids coincide, 0 when they are one face width apart
+            closeness = 1 - np.linalg.norm(centroids[:, None] - last_centroids[None], axis=2) / \
+                np.maximum(widths[:, None], 1)
+            pairs += [(free_faces[i], free_tracks[j]) for i, j in greedy_assignment(closeness, 0)]
+
+        for i, j in pairs:
+            self.tracks[j].update(faces[i])
+            assigned[i] = self.tracks[j]
+        matched = {id(track) for track in assigned if track is not None}
+        for track in self.tracks:
+            if id(track) not in matched:
+                track.missed += 1
+        for i, d in enumerate(faces):
+            if assigned[i] is None:
+                assigned[i] = Track(next(self.track_ids), d)
+
+        # Lost tracks are kept for a few frames, so a missed detection keeps its name
+        self.tracks = assigned + [track for track in self.tracks
+                                  if id(track) not in matched and track.missed <= self.max_missed]
+        return assigned
+
+    def reset_names(self):
+        """Forget all recognition results, e.g. after the gallery changed"""
+        for track in self.tracks:
+            track.forget()
@@ -1,102 +1,257 @@
-# Extract features from images and save into "features_all.csv"
+# Extract features from images and save into the binary gallery "features_all.npy"
 
 import os
-import dlib
-import csv
+import argparse
+import contextlib
+import multiprocessing
+import time
 import numpy as np
 import logging
 import cv2
+from face_gallery import FaceGallery, save_gallery, PATH_GALLERY
+from face_embedding import face_landmarks, compute_descriptors_batch
+from descriptor_cache import DescriptorCache, image_stamp, model_hash, person_signature
+from recognition_service import connect_service
+from model_registry import get_detector, get_predictor, get_face_reco_model, PATH_PREDICTOR, PATH_FACE_RECO_MODEL
 
 #  Path of cropped faces
 path_images_from_camera = "data/data_faces_from_camera/"
 
-#  Use frontal face detector of Dlib
-detector = dlib.get_frontal_face_detector()
 
-#  Get face landmarks
-predictor = dlib.shape_predictor('data/data_dlib/shape_predictor_68_face_landmarks.dat')
+# Stages timed for every image, reported as throughput at the end of a run
+STAGES = ("read", "detect", "landmarks", "descriptor")
 
-#  Use Dlib resnet50 model to get 128D face descriptor
-face_reco_model = dlib.face_recognition_model_v1("data/data_dlib/dlib_face_recognition_resnet_model_v1.dat")
 
+#  Mean of the descriptors of one person, computed the same way whether they were cached or not
 
-#  Return 128D features for single image
+def mean_of_descriptors(features_list_personX):
+    if features_list_personX:
+        return np.mean(np.asarray(features_list_personX, dtype=np.float32), axis=0,
+                       dtype=np.float64).astype(np.float32)
+    return np.zeros(128, dtype=np.float32)
 
-def return_128d_features(path_img):
-    img_rd = cv2.imread(path_img)
-    faces = detector(img_rd, 1)
 
-    logging.info("%-40s %-20s", " Image with faces detected:", path_img)
+#  Images are embedded in chunks of this size with one batched descriptor call; the chunking
+#  does not depend on the number of workers, so serial and parallel runs give the same result
+CHUNK_SIZE = 16
 
-    # For photos of faces saved, we need to make sure that we can detect faces from the cropped images
-    if len(faces) != 0:
-        shape = predictor(img_rd, faces[0])
-        face_descriptor = face_reco_model.compute_face_descriptor(img_rd, shape)
-    else:
-        face_descriptor = 0
-        logging.warning("no face")
-    return face_descriptor
-
-
-#   Return the mean value of 128D face descriptor for person X
-
-def return_features_mean_personX(path_face_personX):
-    features_list_personX = []
-    photos_list = os.listdir(path_face_personX)
-    if photos_list:
-        for i in range(len(photos_list)):
-            #  return_128d_features()  128D  / Get 128D features for single image of personX
-            logging.info("%-40s %-20s", " / Reading image:", path_face_personX + "/" + photos_list[i])
-            features_128d = return_128d_features(path_face_personX + "/" + photos_list[i])
-            #  Jump if no face detected from image
-            if features_128d == 0:
-                i += 1
-            else:
-                features_list_personX.append(features_128d)
-    else:
-        logging.warning(" Warning: No images in%s/", path_face_personX)
 
-   
-    if features_list_personX:
-        features_mean_personX = np.array(features_list_personX, dtype=object).mean(axis=0)
+#  Return features of a chunk of images: [(path, float32 descriptor or None, seconds per stage), ...]
+
+def compute_chunk(paths_img):
+    imgs = []
+    shapes_list = []
+    timings_list = []
+    for path_img in paths_img:
+        t0 = time.perf_counter()
+        img_rd = cv2.imread(path_img)
+        t1 = time.perf_counter()
+        faces = get_detector()(img_rd, 1)
+        t2 = time.perf_counter()
+        # Only the first face of the cropped image is used
+        shapes = face_landmarks(get_predictor(), img_rd, faces[:1])
+        t3 = time.perf_counter()
+        if len(faces) == 0:
+            logging.warning("no face: %s", path_img)
+        imgs.append(img_rd)
+        shapes_list.append(shapes)
+        timings = {"read": t1 - t0, "detect": t2 - t1}
+        if len(faces):
+            timings["landmarks"] = t3 - t2
+        timings_list.append(timings)
+
+    t0 = time.perf_counter()
+    descriptors = compute_descriptors_batch(get_face_reco_model(), imgs, shapes_list)
+    faces_cnt = sum(len(shapes) for shapes in shapes_list)
+    # Share the time of the batched call among the faces of the chunk
+    seconds_per_face = (time.perf_counter() - t0) / faces_cnt if faces_cnt else 0.0
+
+    results = []
+    for path_img, face_descriptors, timings in zip(paths_img, descriptors, timings_list):
+        if len(face_descriptors):
+            timings["descriptor"] = seconds_per_face
+            results.append((path_img, face_descriptors[0], timings))
+        else:
+            results.append((path_img, None, timings))
+    return results
+
+
+#  Process pool workers: dlib models are loaded once per worker, on its first chunk
+
+def init_worker():
+    # Per-image logs of every worker would interleave, keep warnings only
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+#  Compute descriptors of `paths_img`, in order, serially or on a pool of `workers` processes;
+#  serial chunks hold `lock` while they use the models of this process
+
+def compute_images_descriptors(paths_img, workers=1, lock=None):
+    chunks = [paths_img[i:i + CHUNK_SIZE] for i in range(0, len(paths_img), CHUNK_SIZE)]
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            with lock or contextlib.nullcontext():
+                results = compute_chunk(chunk)
+            for result in results:
+                yield result
+        return
+    with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+        # imap keeps the input order, so results are reassembled deterministically
+        for results in pool.imap(compute_chunk, chunks):
+            for result in results:
+                yield result
+
+
+def parse_person_folder(person):
+    # Parse person folder name to extract name, department, and position
+    parts = person.split('_')
+    if len(parts) >= 2:
+        person_name = parts[2] if len(parts) > 2 else "Unknown"
+        department = parts[3] if len(parts) > 3 else ""
+        position = parts[4] if len(parts) > 4 else ""
     else:
-        features_mean_personX = np.zeros(128, dtype=object, order='C')
-    return features_mean_personX
+        person_name = person
+        department = ""
+        position = ""
+    return person_name, department, position
 
 
-def main():
-    logging.basicConfig(level=logging.INFO)
+#  Build the gallery from "data/data_faces_from_camera/", only computing new or changed images;
+#  `lock` guards the models when they are shared, e.g. by the recognition service; with `folders`, only
+#  those person folders are looked at, the others keep their cached mean; returns a summary of the run
+
+def extract_features(rebuild=False, use_cache=True, workers=1, lock=None, folders=None):
+    start = time.time()
+    cache = None
+    if use_cache:
+        cache = DescriptorCache(model_hash(PATH_PREDICTOR, PATH_FACE_RECO_MODEL), refresh=rebuild)
+
     #  Get the order of latest person
     person_list = os.listdir("data/data_faces_from_camera/")
     person_list.sort()
 
-    with open("data/features_all.csv", "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        for person in person_list:
-            # Get the mean/average features of face/personX, it will be a list with a length of 128D
-            logging.info("%sperson_%s", path_images_from_camera, person)
-            features_mean_personX = return_features_mean_personX(path_images_from_camera + person)
-
-            # Parse person folder name to extract name, department, and position
-            parts = person.split('_')
-            if len(parts) >= 2:
-                person_name = parts[2] if len(parts) > 2 else "Unknown"
-                department = parts[3] if len(parts) > 3 else ""
-                position = parts[4] if len(parts) > 4 else ""
+    # 1. Find the persons whose cached mean can be reused and the images that must be computed
+    features_mean_all = {}
+    paths_img_all = {}
+    stamps = {}
+    descriptors = {}
+    paths_pending = []
+    for person in person_list:
+        folder = path_images_from_camera + person
+        if cache is not None and folders is not None and person not in folders:
+            # Enrollment of other people, this one is taken from the cache without a look at its images
+            features_mean_personX = cache.get_person(folder, None, 0)
+            if features_mean_personX is not None:
+                features_mean_all[person] = (features_mean_personX, None)
+                continue
+        paths_img = [folder + "/" + photo for photo in sorted(os.listdir(folder))]
+        paths_img_all[person] = paths_img
+        if not paths_img:
+            logging.warning(" Warning: No images in%s/", folder)
+        if cache is None:
+            paths_pending.extend(paths_img)
+            continue
+
+        stamps.update({path_img: image_stamp(path_img) for path_img in paths_img})
+        signature = person_signature({path_img: stamps[path_img] for path_img in paths_img})
+        features_mean_personX = cache.get_person(folder, signature, len(paths_img))
+        if features_mean_personX is not None:
+            logging.info("%-40s %-20s", " / Unchanged, reusing cached mean:", folder)
+            features_mean_all[person] = (features_mean_personX, signature)
+            continue
+        features_mean_all[person] = (None, signature)
+        for path_img in paths_img:
+            found, face_descriptor = cache.get(path_img, stamps[path_img])
+            if found:
+                descriptors[path_img] = face_descriptor
             else:
-                person_name = person
-                department = ""
-                position = ""
-            
-            # Insert name, department, position, then 128 features
-            features_mean_personX = np.insert(features_mean_personX, 0, position, axis=0)  # position first
-            features_mean_personX = np.insert(features_mean_personX, 0, department, axis=0)  # department second
-            features_mean_personX = np.insert(features_mean_personX, 0, person_name, axis=0)  # name third
-            # features_mean_personX will be 131D: name + department + position + 128 features
-            writer.writerow(features_mean_personX)
-            logging.info('\n')
-        logging.info("Save all the features of faces registered into: data/features_all.csv")
+                paths_pending.append(path_img)
+
+    # 2. Compute the missing descriptors, in parallel if asked
+    logging.info("%d images to process with %d worker(s)", len(paths_pending), workers)
+    stage_seconds = dict.fromkeys(STAGES, 0.0)
+    stage_cnt = dict.fromkeys(STAGES, 0)
+    compute_start = time.time()
+    for path_img, face_descriptor, timings in compute_images_descriptors(paths_pending, workers, lock):
+        descriptors[path_img] = face_descriptor
+        for stage, seconds in timings.items():
+            stage_seconds[stage] += seconds
+            stage_cnt[stage] += 1
+        if cache is not None:
+            cache.put(path_img, stamps[path_img], face_descriptor, sum(timings.values()))
+    compute_seconds = time.time() - compute_start
+
+    # 3. Assemble the gallery in person order
+    person_names = []
+    departments = []
+    positions = []
+    features_all = []
+    for person in person_list:
+        # Get the mean/average features of face/personX, it will be a list with a length of 128D
+        logging.info("%sperson_%s", path_images_from_camera, person)
+        features_mean_personX, signature = features_mean_all.get(person, (None, None))
+        if features_mean_personX is None:
+            paths_img = paths_img_all[person]
+            features_mean_personX = mean_of_descriptors(
+                [descriptors[path_img] for path_img in paths_img if descriptors[path_img] is not None])
+            if cache is not None:
+                cache.put_person(path_images_from_camera + person, signature, features_mean_personX, paths_img)
+
+        person_name, department, position = parse_person_folder(person)
+        person_names.append(person_name)
+        departments.append(department)
+        positions.append(position)
+        features_all.append(np.asarray(features_mean_personX, dtype=np.float32))
+
+    # float32 matrix of 128D features + sidecar with name, department and position
+    header = save_gallery(FaceGallery(features_all, person_names, departments, positions), PATH_GALLERY)
+    logging.info("Save all the features of faces registered into: %s", PATH_GALLERY)
+
+    if paths_pending:
+        logging.info("Processed %d images in %.1f s (%.1f images/s)", len(paths_pending), compute_seconds,
+                     len(paths_pending) / compute_seconds if compute_seconds else 0.0)
+        for stage in STAGES:
+            if stage_cnt[stage]:
+                logging.info("  %-12s %6d images  %8.1f ms/image  %8.1f images/s per worker", stage,
+                             stage_cnt[stage], stage_seconds[stage] * 1000 / stage_cnt[stage],
+                             stage_cnt[stage] / stage_seconds[stage] if stage_seconds[stage] else 0.0)
+    if cache is not None and folders is None:
+        # Only a full run knows every image
+        cache.prune([path_img for paths_img in paths_img_all.values() for path_img in paths_img],
+                    [path_images_from_camera + person for person in person_list])
+        logging.info("Descriptor cache: %d hits, %d misses (hit rate %.1f%%), %d persons reused, "
+                     "about %.1f s saved", cache.hits, cache.misses, cache.hit_rate * 100,
+                     cache.persons_reused, cache.seconds_saved)
+        cache.close()
+    logging.info("Feature extraction finished in %.1f s", time.time() - start)
+    return {"people": len(person_list), "images_processed": len(paths_pending),
+            "generation": header["generation"], "seconds": round(time.time() - start, 3)}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Extract 128D features of registered faces into the gallery")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute every image, ignoring the cache")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the descriptor cache")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes for detection and descriptors, 0 for one per CPU core")
+    parser.add_argument("--local", action="store_true",
+                        help="Extract in this process even when the recognition service is running")
+    args = parser.parse_args()
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+
+    # The recognition service already has the models loaded
+    client = None if args.local else connect_service()
+    if client is not None:
+        with client:
+            summary = client.rebuild_gallery(rebuild=args.rebuild, use_cache=not args.no_cache, workers=workers)
+        logging.info("Gallery rebuilt by the recognition service: %d people, %d images processed in %.1f s",
+                     summary["people"], summary["images_processed"], summary["seconds"])
+        return
+    extract_features(args.rebuild, not args.no_cache, workers)
 
 
 if __name__ == '__main__':
+    # Needed by the process pool in frozen Windows builds
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
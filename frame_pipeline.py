@@ -0,0 +1,196 @@
+"""
+Building blocks of the pipelined attendance loop
+Capture, detection / tracking and recognition run on their own threads,
+connected by small bounded queues that drop the oldest item when full, so the
+display always works on the freshest frame
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from stage_timer import NO_TIMERS
+
+
+class DropOldestQueue:
+    """Bounded FIFO queue whose put() never blocks: when full the oldest item is dropped"""
+
+    def __init__(self, maxsize=1):
+        self.items = collections.deque()
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        """Add `item`, return the item dropped to make room for it or None"""
+        dropped_item = None
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                dropped_item = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+        return dropped_item
+
+    def get(self, timeout=None):
+        """Oldest item, or None after `timeout` seconds or once the queue is closed and empty"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+            return self.items.popleft() if self.items else None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
+
+
+class CaptureThread(threading.Thread):
+    """Read frames from a cv2.VideoCapture as fast as it delivers them
+
+    Items put into `frames` are (frame_cnt, capture_time, img); `frames` is
+    closed when the stream ends.
+    """
+
+    def __init__(self, stream, frames, timers=NO_TIMERS):
+        super().__init__(name="CaptureThread", daemon=True)
+        self.stream = stream
+        self.frames = frames
+        self.timers = timers
+        self.frame_cnt = 0
+        self.stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set() and self.stream.isOpened():
+                with self.timers.stage("read"):
+                    flag, img_rd = self.stream.read()
+                if not flag:
+                    break
+                self.frame_cnt += 1
+                self.frames.put((self.frame_cnt, time.time(), img_rd))
+        finally:
+            self.frames.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class PipelineStats:
+    """End-to-end latency and drop counters, logged every `interval` seconds"""
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.latencies = []
+        self.frames_shown = 0
+        self.last_report = time.time()
+
+    def frame_shown(self, capture_time):
+        self.frames_shown += 1
+        self.latencies.append(time.time() - capture_time)
+
+    def report(self, frames_queue, jobs_queue, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            logging.info("Pipeline: %.1f fps shown, latency avg %.1f ms / p95 %.1f ms / max %.1f ms, "
+                         "dropped %d frames, %d recognition jobs",
+                         self.frames_shown / (now - self.last_report),
+                         sum(latencies) * 1000 / len(latencies),
+                         latencies[int(len(latencies) * 0.95)] * 1000, latencies[-1] * 1000,
+                         frames_queue.dropped, jobs_queue.dropped)
+        self.latencies = []
+        self.frames_shown = 0
+        self.last_report = now
+
+
+class FairScheduler:
+    """Drop-oldest job queues, one per stream, served round robin
+
+    A camera with many faces in view cannot starve the others: get() takes the
+    next job from the stream after the one served last.
+    """
+
+    def __init__(self, streams_cnt, maxsize=2):
+        self.queues = [collections.deque() for _ in range(streams_cnt)]
+        self.maxsize = maxsize
+        self.next_stream = 0
+        self.served = [0] * streams_cnt
+        self.dropped = [0] * streams_cnt
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, stream_index, item):
+        """Add `item` for a stream, return the job of that stream dropped to make room or None"""
+        dropped_item = None
+        with self.cond:
+            queue = self.queues[stream_index]
+            if len(queue) >= self.maxsize:
+                dropped_item = queue.popleft()
+                self.dropped[stream_index] += 1
+            queue.append(item)
+            self.cond.notify()
+        return dropped_item
+
+    def get(self, timeout=None):
+        """Oldest job of the next stream with work, or None after `timeout` / once closed and empty"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: any(self.queues) or self.closed, timeout):
+                return None
+            for offset in range(len(self.queues)):
+                stream_index = (self.next_stream + offset) % len(self.queues)
+                if self.queues[stream_index]:
+                    self.next_stream = stream_index + 1
+                    self.served[stream_index] += 1
+                    return self.queues[stream_index].popleft()
+            return None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class ThroughputStats:
+    """Frames, faces and recognitions processed, logged every `interval` seconds (headless mode)"""
+
+    def __init__(self, interval=10.0, name=None):
+        self.interval = interval
+        # Stream the numbers belong to, in multi-camera mode
+        self.name = name
+        self.fps = 0.0
+        self.start = time.time()
+        self.last_report = self.start
+        self.frames = 0
+        self.faces = 0
+        self.recognized = 0
+        self.total_frames = 0
+
+    def frame_done(self, faces_cnt, recognized_cnt=0):
+        self.frames += 1
+        self.faces += faces_cnt
+        self.recognized += recognized_cnt
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        elapsed = max(now - self.last_report, 1e-6)
+        self.total_frames += self.frames
+        self.fps = self.frames / elapsed
+        logging.info("Throughput%s: %.1f fps, %.2f faces / frame, %d faces sent to recognition, "
+                     "%d frames in %.0f s",
+                     " [%s]" % self.name if self.name else "", self.fps, self.faces / self.frames if self.frames else 0.0,
+                     self.recognized, self.total_frames, now - self.start)
+        self.frames = 0
+        self.faces = 0
+        self.recognized = 0
+        self.last_report = now
@@ -1,17 +1,17 @@
-import dlib
 import numpy as np
 import cv2
 import os
 import shutil
+import glob
 import time
 import logging
+import threading
 import tkinter as tk
 from tkinter import font as tkFont
 from PIL import Image, ImageTk
-import pyttsx3
-
-# Use frontal face detector of Dlib
-detector = dlib.get_frontal_face_detector()
+from speech_service import SpeechService
+from face_detection import ScaledDetector
+from recognition_service import ServiceError, connect_service
 
 
 class Face_Register:
@@ -52,6 +52,12 @@ class Face_Register:
         self.font_step_title = tkFont.Font(family='Helvetica', size=15, weight='bold')
         self.font_warning = tkFont.Font(family='Helvetica', size=15, weight='bold')
 
+        # Frames of the preview are RGB, detection runs on a grayscale copy
+        self.face_detector = ScaledDetector(color="rgb")
+
+        # Saved faces are enrolled right away when the recognition service is running
+        self.service = connect_service()
+
         self.path_photos_from_camera = "data/data_faces_from_camera/"
         self.current_face_dir = ""
         self.font = cv2.FONT_ITALIC
@@ -80,11 +86,8 @@ class Face_Register:
 
         # self.cap = cv2.VideoCapture("test.mp4")   # Input local video
 
-        # Text-to-Speech engine (offline)
-        try:
-            self.tts_engine = pyttsx3.init()
-        except Exception:
-            self.tts_engine = None
+        # Text-to-Speech (offline) on its own thread, so the preview never waits on audio
+        self.speech = SpeechService()
 
     #  Delete old face folders
     def GUI_clear_data(self):
@@ -92,11 +95,12 @@ class Face_Register:
         folders_rd = os.listdir(self.path_photos_from_camera)
         for i in range(len(folders_rd)):
             shutil.rmtree(self.path_photos_from_camera + folders_rd[i])
-        if os.path.isfile("data/features_all.csv"):
-            os.remove("data/features_all.csv")
+        for path_features in glob.glob("data/features_all.*"):
+            if os.path.isfile(path_features):
+                os.remove(path_features)
         self.label_cnt_face_in_database['text'] = "0"
         self.existing_faces_cnt = 0
-        self.log_all["text"] = "Face images and `features_all.csv` removed!"
+        self.log_all["text"] = "Face images and `features_all` removed!"
 
     def GUI_get_input_name(self):
         self.input_name_char = self.input_name.get()
@@ -105,14 +109,10 @@ class Face_Register:
         self.create_face_folder()
         self.label_cnt_face_in_database['text'] = str(self.existing_faces_cnt)
         # Announce input name and folder creation
-        if self.tts_engine and self.input_name_char:
-            try:
-                dept_info = f" from {self.input_department_char}" if self.input_department_char else ""
-                pos_info = f", {self.input_position_char}" if self.input_position_char else ""
-                self.tts_engine.say(f"Registering {self.input_name_char}{dept_info}{pos_info}. Folder created successfully.")
-                self.tts_engine.runAndWait()
-            except Exception:
-                pass
+        if self.input_name_char:
+            dept_info = f" from {self.input_department_char}" if self.input_department_char else ""
+            pos_info = f", {self.input_position_char}" if self.input_position_char else ""
+            self.speech.say(f"Registering {self.input_name_char}{dept_info}{pos_info}. Folder created successfully.")
 
     def GUI_info(self):
         tk.Label(self.frame_right_info,
@@ -246,14 +246,11 @@ class Face_Register:
                     cv2.imwrite(self.current_face_dir + "/img_face_" + str(self.ss_cnt) + ".jpg", self.face_ROI_image)
                     logging.info("%-40s %s/img_face_%s.jpg", "Save into：",
                                  str(self.current_face_dir), str(self.ss_cnt) + ".jpg")
+                    self.enroll_current_face()
                     # Speak success after first saved image for this person
-                    if self.tts_engine and self.ss_cnt == 1:
-                        try:
-                            person_name = self.input_name_char if self.input_name_char else "person"
-                            self.tts_engine.say(f"{person_name} registered successfully")
-                            self.tts_engine.runAndWait()
-                        except Exception:
-                            pass
+                    if self.ss_cnt == 1:
+                        person_name = self.input_name_char if self.input_name_char else "person"
+                        self.speech.say(f"{person_name} registered successfully")
                 else:
                     self.log_all["text"] = "Please do not out of range!"
             else:
@@ -261,6 +258,21 @@ class Face_Register:
         else:
             self.log_all["text"] = "Please run step 2!"
 
+    #  Add the saved images to the gallery of the recognition service, the recognizer picks it up within seconds
+    def enroll_current_face(self):
+        if self.service is None:
+            return
+        folder = self.current_face_dir
+
+        def enroll():
+            try:
+                summary = self.service.enroll(folder)
+                logging.info("%-40s %s (gallery generation %d)", "Enrolled:", folder, summary["generation"])
+            except (ServiceError, OSError, EOFError) as e:
+                logging.warning("Could not enroll %s: %s", folder, e)
+
+        threading.Thread(target=enroll, name="Enroll", daemon=True).start()
+
     def get_frame(self):
         try:
             if self.cap.isOpened():
@@ -273,7 +285,7 @@ class Face_Register:
     #  Main process of face detection and saving
     def process(self):
         ret, self.current_frame = self.get_frame()
-        faces = detector(self.current_frame, 0)
+        faces = self.face_detector(self.current_frame)
         # Get frame
         if ret:
             self.update_fps()
@@ -322,6 +334,9 @@ class Face_Register:
         self.GUI_info()
         self.process()
         self.win.mainloop()
+        self.speech.close()
+        if self.service is not None:
+            self.service.close()
 
 
 def main():
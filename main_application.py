@@ -7,16 +7,23 @@ import tkinter as tk
 from tkinter import ttk, messagebox, font
 import subprocess
 import os
+import queue
 import sys
 import threading
 from datetime import datetime
 import webbrowser
 from version import VersionManager, check_updates_async
+from recognition_service import ServiceError, connect_service, start_service
 
 class ModernAttendanceApp:
     def __init__(self):
         self.root = tk.Tk()
         self.version_manager = VersionManager()
+        # Resident recognition service, started in the background; keeps the models and gallery warm
+        self.service = None
+        self.service_started = False
+        # Status text from the service thread, shown by the Tk thread (Tk is not thread-safe)
+        self.service_status = queue.Queue()
         self.setup_window()
         self.create_menu()
         self.create_main_interface()
@@ -24,6 +31,27 @@ class ModernAttendanceApp:
         
         # Check for updates on startup
         self.check_updates_on_startup()
+        threading.Thread(target=self.start_recognition_service, daemon=True).start()
+        self.poll_service_status()
+
+    def start_recognition_service(self):
+        """Connect to the recognition service, starting it if it is not running yet; runs on its own thread"""
+        self.service = connect_service()
+        if self.service is None:
+            self.service = start_service()
+            self.service_started = self.service is not None
+        # None tells the poll that the thread is done
+        self.service_status.put("Recognition service ready" if self.service is not None else None)
+
+    def poll_service_status(self):
+        """Show the status of the service thread in the status bar, until it is done"""
+        try:
+            status = self.service_status.get_nowait()
+        except queue.Empty:
+            self.root.after(200, self.poll_service_status)
+            return
+        if status is not None:
+            self.status_label.config(text=status)
     
     def setup_window(self):
         """Setup main window properties"""
@@ -164,14 +192,16 @@ class ModernAttendanceApp:
         stat_items = [
             ("Registered People", stats['registered_people'], self.colors['success']),
             ("Today's Attendance", stats['today_attendance'], self.colors['secondary']),
+            ("First Arrival Today", stats['first_arrival'], self.colors['secondary']),
+            ("This Month", stats['month_attendance'], self.colors['secondary']),
             ("Database Size", stats['db_size'], self.colors['warning']),
             ("System Status", stats['system_status'], self.colors['success'])
         ]
         
         for i, (label, value, color) in enumerate(stat_items):
             stat_frame = tk.Frame(stats_frame, bg=color, relief=tk.RAISED, bd=1)
-            stat_frame.grid(row=0, column=i, padx=5, sticky='ew')
-            stats_frame.grid_columnconfigure(i, weight=1)
+            stat_frame.grid(row=i // 3, column=i % 3, padx=5, pady=5, sticky='ew')
+            stats_frame.grid_columnconfigure(i % 3, weight=1)
             
             tk.Label(stat_frame, text=value, font=('Arial', 18, 'bold'), 
                     fg='white', bg=color).pack(pady=5)
@@ -224,21 +254,27 @@ class ModernAttendanceApp:
             if os.path.exists(faces_dir):
                 people_count = len([d for d in os.listdir(faces_dir) if os.path.isdir(os.path.join(faces_dir, d))])
             
-            # Count today's attendance
+            # Today's and this month's attendance, read from the summary tables
             today_count = 0
+            first_arrival = "-"
+            month_count = 0
             if os.path.exists("attendance.db"):
-                import sqlite3
-                conn = sqlite3.connect("attendance.db")
-                cursor = conn.cursor()
-                today = datetime.now().strftime('%Y-%m-%d')
-                cursor.execute("SELECT COUNT(*) FROM attendance WHERE date = ?", (today,))
-                today_count = cursor.fetchone()[0]
+                import attendance_db
+                conn = attendance_db.connect("attendance.db")
+                today_count, first_seconds, _ = attendance_db.daily_summary(conn, datetime.now().date())
+                if first_seconds is not None:
+                    first_arrival = attendance_db.time_string(first_seconds)[:5]
+                month = int(datetime.now().strftime('%Y%m'))
+                month_count = sum(row[2] for row in attendance_db.monthly_summaries(conn, month, month))
                 conn.close()
             
             # Database size
             db_size = "0 KB"
             if os.path.exists("attendance.db"):
                 size_bytes = os.path.getsize("attendance.db")
+                # Recent commits live in the write-ahead log until the next checkpoint
+                if os.path.exists("attendance.db-wal"):
+                    size_bytes += os.path.getsize("attendance.db-wal")
                 if size_bytes > 1024:
                     db_size = f"{size_bytes // 1024} KB"
                 else:
@@ -247,6 +283,8 @@ class ModernAttendanceApp:
             return {
                 'registered_people': people_count,
                 'today_attendance': today_count,
+                'first_arrival': first_arrival,
+                'month_attendance': month_count,
                 'db_size': db_size,
                 'system_status': 'Online'
             }
@@ -254,6 +292,8 @@ class ModernAttendanceApp:
             return {
                 'registered_people': 0,
                 'today_attendance': 0,
+                'first_arrival': '-',
+                'month_attendance': 0,
                 'db_size': '0 KB',
                 'system_status': 'Error'
             }
@@ -289,7 +329,11 @@ class ModernAttendanceApp:
         self.status_label.config(text="Opening Attendance Taker...")
         try:
             if os.path.exists("attendance_taker.py"):
-                subprocess.Popen([sys.executable, "attendance_taker.py"])
+                command = [sys.executable, "attendance_taker.py"]
+                if self.service is not None:
+                    # Faces are embedded by the warm service, no models to load
+                    command.append("--use-service")
+                subprocess.Popen(command)
                 self.status_label.config(text="Attendance Taker opened")
             else:
                 messagebox.showerror("Error", "Attendance taker module not found")
@@ -317,8 +361,20 @@ class ModernAttendanceApp:
         """Extract features from registered faces"""
         self.status_label.config(text="Extracting features...")
         try:
+            if self.service is not None:
+                try:
+                    summary = self.service.rebuild_gallery()
+                    messagebox.showinfo("Success", "Features extracted successfully!\n"
+                                        f"{summary['people']} people, {summary['images_processed']} new images "
+                                        f"in {summary['seconds']:.1f} s")
+                    self.status_label.config(text="Features extracted successfully")
+                    return
+                except (ServiceError, OSError, EOFError) as e:
+                    # Fall back to a local extraction
+                    self.service = None
+                    self.status_label.config(text=f"Recognition service failed: {e}")
             if os.path.exists("features_extraction_to_csv.py"):
-                result = subprocess.run([sys.executable, "features_extraction_to_csv.py"], 
+                result = subprocess.run([sys.executable, "features_extraction_to_csv.py", "--local"], 
                                       capture_output=True, text=True)
                 if result.returncode == 0:
                     messagebox.showinfo("Success", "Features extracted successfully!")
@@ -394,6 +450,14 @@ GitHub: https://github.com/Ephraimraxy/Camera
     def run(self):
         """Start the application"""
         self.root.mainloop()
+        if self.service is not None:
+            try:
+                # A service started by this window stops with it
+                if self.service_started:
+                    self.service.shutdown()
+                self.service.close()
+            except (ServiceError, OSError, EOFError):
+                pass
 
 if __name__ == "__main__":
     app = ModernAttendanceApp()
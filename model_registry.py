@@ -0,0 +1,75 @@
+"""
+Lazily loaded dlib models shared by every entry point
+Nothing is loaded at import: each model is loaded once, on first use or by
+preload() on a background thread, so the camera can open in the meantime
+"""
+
+import logging
+import threading
+import time
+
+PATH_PREDICTOR = "data/data_dlib/shape_predictor_68_face_landmarks.dat"
+PATH_FACE_RECO_MODEL = "data/data_dlib/dlib_face_recognition_resnet_model_v1.dat"
+
+MODELS = ("detector", "predictor", "face_reco_model")
+
+_models = {}
+_locks = {name: threading.Lock() for name in MODELS}
+# Seconds each model took to load, for the startup report
+load_seconds = {}
+
+
+def _load(name):
+    import dlib
+    if name == "detector":
+        # Dlib  / Use frontal face detector of Dlib
+        return dlib.get_frontal_face_detector()
+    if name == "predictor":
+        # Dlib landmark / Get face landmarks
+        return dlib.shape_predictor(PATH_PREDICTOR)
+    # Dlib Resnet Use Dlib resnet50 model to get 128D face descriptor
+    return dlib.face_recognition_model_v1(PATH_FACE_RECO_MODEL)
+
+
+def get_model(name):
+    """The model `name`, loaded on the first call; concurrent callers wait for the same load"""
+    model = _models.get(name)
+    if model is not None:
+        return model
+    with _locks[name]:
+        if name not in _models:
+            start = time.perf_counter()
+            _models[name] = _load(name)
+            load_seconds[name] = time.perf_counter() - start
+            logging.debug("Model %s loaded in %.1f ms", name, load_seconds[name] * 1000)
+        return _models[name]
+
+
+def get_detector():
+    return get_model("detector")
+
+
+def get_predictor():
+    return get_model("predictor")
+
+
+def get_face_reco_model():
+    return get_model("face_reco_model")
+
+
+def preload(names=MODELS, callback=None):
+    """Load `names` on a background thread, call `callback` once they are loaded; return the thread"""
+    def load_all():
+        for name in names:
+            try:
+                get_model(name)
+            except (ImportError, RuntimeError, OSError) as e:
+                # The caller that needs the model gets the error again
+                logging.warning("Could not load model %s: %s", name, e)
+                return
+        if callback is not None:
+            callback()
+
+    thread = threading.Thread(target=load_all, name="ModelLoader", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,415 @@
+"""
+Resident recognition service for Face Recognition Attendance System
+One long-running process keeps the dlib models and the gallery warm and
+answers detect, embed, recognize, enroll and rebuild-gallery requests over a
+local socket, so the GUI tools and the extraction script start in milliseconds
+instead of loading the models every time
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener, AuthenticationError
+
+# host:port on localhost, or the path of a unix socket
+DEFAULT_ADDRESS = os.environ.get("FACE_SERVICE_ADDRESS", "127.0.0.1:6543")
+# Shared secret of the service and its clients, written by the service at start
+PATH_SERVICE_KEY = "data/service.key"
+PATH_IMAGES_FROM_CAMERA = "data/data_faces_from_camera/"
+
+
+class ServiceError(RuntimeError):
+    """An operation failed inside the recognition service"""
+
+
+def parse_address(address):
+    """("host", port) for "host:port", the path itself for a unix socket"""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and os.sep not in address:
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+def rects_to_boxes(rects):
+    return [(d.left(), d.top(), d.right(), d.bottom()) for d in rects]
+
+
+def boxes_to_rects(boxes):
+    import dlib
+    rects = dlib.rectangles()
+    for left, top, right, bottom in boxes:
+        rects.append(dlib.rectangle(int(left), int(top), int(right), int(bottom)))
+    return rects
+
+
+class GalleryBuilder:
+    """Runs gallery rebuilds on its own thread, one at a time
+
+    A request waits for a rebuild that starts after it arrived; requests that
+    arrive while one runs are served together by the next.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self.cond = threading.Condition()
+        self.requested = 0
+        self.finished = 0
+        # Options of the waiting requests, None when there are none
+        self.options = None
+        self.result = None
+        threading.Thread(target=self.run, name="GalleryBuilder", daemon=True).start()
+
+    def request(self, rebuild=False, use_cache=True, workers=1, folders=None):
+        """Summary of the rebuild that served this request, its exception if it failed
+
+        `folders` limits the rebuild to these person folders, None looks at all of them.
+        """
+        with self.cond:
+            if self.options is None:
+                self.options = (rebuild, use_cache, workers, folders)
+            else:
+                # One rebuild for all, with the most thorough options asked for
+                merged_folders = None if self.options[3] is None or folders is None else self.options[3] | folders
+                self.options = (self.options[0] or rebuild, self.options[1] and use_cache,
+                                max(self.options[2], workers), merged_folders)
+            self.requested += 1
+            ticket = self.requested
+            self.cond.notify_all()
+            while self.finished < ticket:
+                self.cond.wait()
+            ok, result = self.result
+        if not ok:
+            raise result
+        return result
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.finished == self.requested:
+                    self.cond.wait()
+                served = self.requested
+                options, self.options = self.options, None
+            try:
+                result = (True, self.build(*options))
+            except Exception as e:
+                logging.exception("Gallery rebuild failed")
+                result = (False, e)
+            with self.cond:
+                self.finished = served
+                self.result = result
+                self.cond.notify_all()
+
+
+class RecognitionService:
+    # Operations that wait on the gallery builder instead of holding the lock
+    BACKGROUND_OPS = ("enroll", "rebuild_gallery")
+
+    def __init__(self, address=DEFAULT_ADDRESS, path_key=PATH_SERVICE_KEY):
+        from attendance_taker import load_known_faces
+        from face_detection import ScaledDetector
+        from face_gallery import FaceGallery, GalleryWatcher, PATH_GALLERY
+        from face_index import load_or_build_index
+        from model_registry import preload
+
+        self.address = parse_address(address)
+        self.path_key = path_key
+        # dlib models are not safe to share between threads, requests run one at a time
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.requests = 0
+        self.authkey = None
+
+        preload().join()
+        self.face_detector = ScaledDetector()
+        self.load_or_build_index = load_or_build_index
+        known_faces = load_known_faces()
+        self.gallery = known_faces[0] if known_faces else FaceGallery([])
+        if known_faces:
+            load_or_build_index(*known_faces)
+        # Enrollments by other processes are picked up like in the recognizer
+        self.gallery_watcher = GalleryWatcher(PATH_GALLERY, prepare=load_or_build_index)
+        self.gallery_watcher.start(self.gallery.generation)
+        self.builder = GalleryBuilder(self.rebuild_gallery)
+
+    def update_gallery(self):
+        gallery = self.gallery_watcher.take()
+        if gallery is not None:
+            self.gallery = gallery
+
+    # Operations, called with the keyword arguments of the request
+
+    def op_ping(self):
+        from model_registry import load_seconds
+        return {"pid": os.getpid(), "people": len(self.gallery), "generation": self.gallery.generation,
+                "requests": self.requests, "models": sorted(load_seconds)}
+
+    def op_detect(self, img, upsample=0, scale=1.0):
+        self.face_detector.scale = scale
+        return rects_to_boxes(self.face_detector(img, upsample))
+
+    def op_embed(self, img, boxes):
+        from face_embedding import embed_faces
+        from model_registry import get_predictor, get_face_reco_model
+        return embed_faces(get_predictor(), get_face_reco_model(), img, boxes_to_rects(boxes))
+
+    def op_embed_and_match(self, img, boxes, k=1):
+        """Descriptors, (N, k) ids and distances of the closest people, and the gallery generation"""
+        from attendance_taker import embed_and_match
+        descriptors, ids, distances = embed_and_match(self.gallery, img, boxes_to_rects(boxes), k)
+        return descriptors, ids, distances, self.gallery.generation
+
+    def op_recognize(self, img, boxes=None, threshold=None):
+        """Name, department, position and distance of every face, detected when no boxes are given"""
+        from face_gallery import DISTANCE_THRESHOLD
+        if boxes is None:
+            boxes = self.op_detect(img)
+        descriptors, ids, distances, _ = self.op_embed_and_match(img, boxes, 1)
+        threshold = DISTANCE_THRESHOLD if threshold is None else threshold
+        faces = []
+        for box, person_id, distance in zip(boxes, ids[:, 0], distances[:, 0]):
+            known = person_id >= 0 and distance < threshold
+            name, department, position = self.gallery.person(person_id) if known else ("unknown", "", "")
+            faces.append({"box": tuple(box), "person_id": int(person_id) if known else -1, "name": name,
+                          "department": department, "position": position, "distance": float(distance)})
+        return faces
+
+    def op_people(self):
+        return self.gallery.generation, [self.gallery.person(i) for i in range(len(self.gallery))]
+
+    def rebuild_gallery(self, rebuild=False, use_cache=True, workers=1, folders=None):
+        """Incremental extraction with the warm models, run by the gallery builder"""
+        from attendance_taker import load_known_faces
+        from features_extraction_to_csv import extract_features
+        # The lock is only held per chunk of images, requests are served in between
+        summary = extract_features(rebuild, use_cache, workers, lock=self.lock, folders=folders)
+        known_faces = load_known_faces()
+        if known_faces:
+            self.load_or_build_index(*known_faces)
+            with self.lock:
+                self.gallery = known_faces[0]
+        return summary
+
+    def op_rebuild_gallery(self, rebuild=False, use_cache=True, workers=1):
+        """Rebuild the gallery in the background and wait for it, the new gallery is used right away"""
+        return self.builder.request(rebuild, use_cache, workers)
+
+    def op_enroll(self, folder):
+        """Add or update the person of `folder` in data/data_faces_from_camera/; only its new images are computed"""
+        person = os.path.basename(os.path.normpath(folder))
+        if not os.path.isdir(os.path.join(PATH_IMAGES_FROM_CAMERA, person)):
+            raise ValueError("No registered face folder '%s'" % folder)
+        # The other people keep their cached means, their folders are not read
+        return self.builder.request(folders=frozenset((person,)))
+
+    def op_shutdown(self):
+        self.stop_event.set()
+        # Wake up the accept() of serve_forever with a last connection
+        threading.Thread(target=lambda: Client(self.address, authkey=self.authkey).close(), daemon=True).start()
+        return True
+
+    def handle(self, conn):
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    op, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    break
+                method = getattr(self, "op_" + str(op), None)
+                if method is None:
+                    conn.send((False, "Unknown operation '%s'" % op))
+                    continue
+                start = time.perf_counter()
+                try:
+                    if op in self.BACKGROUND_OPS:
+                        self.requests += 1
+                        result = method(**kwargs)
+                    else:
+                        with self.lock:
+                            self.requests += 1
+                            self.update_gallery()
+                            result = method(**kwargs)
+                    conn.send((True, result))
+                except Exception as e:
+                    logging.exception("Operation %s failed", op)
+                    conn.send((False, "%s: %s" % (type(e).__name__, e)))
+                logging.debug("%s in %.1f ms", op, (time.perf_counter() - start) * 1000)
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        self.authkey = authkey = os.urandom(32)
+        os.makedirs(os.path.dirname(self.path_key) or ".", exist_ok=True)
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            # Stale socket of a service that did not shut down cleanly
+            os.remove(self.address)
+        listener = Listener(self.address, authkey=authkey)
+        # Only processes that can read the key file may connect
+        fd = os.open(self.path_key, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(authkey)
+        logging.info("Recognition service listening on %s, %d people in the gallery", self.address,
+                     len(self.gallery))
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    logging.warning("Rejected connection: %s", e)
+                    continue
+                if self.stop_event.is_set():
+                    conn.close()
+                    break
+                threading.Thread(target=self.handle, args=(conn,), name="ServiceConnection", daemon=True).start()
+        finally:
+            listener.close()
+            self.gallery_watcher.stop()
+            try:
+                os.remove(self.path_key)
+            except OSError:
+                pass
+        logging.info("Recognition service stopped after %d requests", self.requests)
+
+
+class RecognitionClient:
+    """Connection to a running recognition service; every method is one request"""
+
+    def __init__(self, address=DEFAULT_ADDRESS, path_key=PATH_SERVICE_KEY):
+        with open(path_key, "rb") as f:
+            authkey = f.read()
+        self.conn = Client(parse_address(address), authkey=authkey)
+        self.lock = threading.Lock()
+
+    def call(self, op, **kwargs):
+        with self.lock:
+            self.conn.send((op, kwargs))
+            ok, result = self.conn.recv()
+        if not ok:
+            raise ServiceError(result)
+        return result
+
+    def ping(self):
+        return self.call("ping")
+
+    def detect(self, img, upsample=0, scale=1.0):
+        return self.call("detect", img=img, upsample=upsample, scale=scale)
+
+    def embed(self, img, boxes):
+        return self.call("embed", img=img, boxes=boxes)
+
+    def embed_and_match(self, img, boxes, k=1):
+        return self.call("embed_and_match", img=img, boxes=boxes, k=k)
+
+    def recognize(self, img, boxes=None, threshold=None):
+        return self.call("recognize", img=img, boxes=boxes, threshold=threshold)
+
+    def people(self):
+        return self.call("people")
+
+    def enroll(self, folder):
+        return self.call("enroll", folder=folder)
+
+    def rebuild_gallery(self, rebuild=False, use_cache=True, workers=1):
+        return self.call("rebuild_gallery", rebuild=rebuild, use_cache=use_cache, workers=workers)
+
+    def shutdown(self):
+        return self.call("shutdown")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def connect_service(address=DEFAULT_ADDRESS, path_key=PATH_SERVICE_KEY):
+    """A client of the running service, or None when no service is running"""
+    if not os.path.exists(path_key):
+        return None
+    try:
+        return RecognitionClient(address, path_key)
+    except (OSError, EOFError, AuthenticationError) as e:
+        logging.debug("Recognition service not reachable: %s", e)
+        return None
+
+
+def start_service(address=DEFAULT_ADDRESS, path_key=PATH_SERVICE_KEY, timeout=60.0):
+    """Connect to the service, starting it in the background first if needed; None if it does not come up"""
+    client = connect_service(address, path_key)
+    if client is not None:
+        return client
+    path_script = os.path.abspath(__file__)
+    if getattr(sys, "frozen", False) or not os.path.exists(path_script):
+        # In a frozen build sys.executable is the application itself, it would open another main window
+        logging.info("Recognition service cannot be started from this build, using local models")
+        return None
+    subprocess.Popen([sys.executable, path_script, "serve", "--address", address])
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(0.2)
+        client = connect_service(address, path_key)
+        if client is not None:
+            return client
+    logging.warning("Recognition service did not start within %.0f s", timeout)
+    return None
+
+
+class RemoteGallery:
+    """Gallery of the service as seen by the recognizer: names by person id, embedding and matching remote"""
+
+    def __init__(self, client):
+        self.client = client
+        self.generation, self.people = client.people()
+        self.names = [name for name, _, _ in self.people]
+
+    def __len__(self):
+        return len(self.people)
+
+    def person(self, i):
+        return self.people[i]
+
+    def embed_and_match(self, img, rects, k=1):
+        descriptors, ids, distances, generation = self.client.embed_and_match(img, rects_to_boxes(rects), k)
+        if generation != self.generation:
+            # Person ids of the answer refer to the new gallery
+            self.generation, self.people = self.client.people()
+            self.names = [name for name, _, _ in self.people]
+        return descriptors, ids, distances
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Resident recognition service")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_serve = subparsers.add_parser("serve", help="Load the models and the gallery and serve requests")
+    parser_serve.add_argument("--address", default=DEFAULT_ADDRESS,
+                              help="host:port on localhost, or the path of a unix socket")
+    parser_status = subparsers.add_parser("status", help="Show the state of the running service")
+    parser_status.add_argument("--address", default=DEFAULT_ADDRESS)
+    parser_stop = subparsers.add_parser("stop", help="Stop the running service")
+    parser_stop.add_argument("--address", default=DEFAULT_ADDRESS)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        RecognitionService(args.address).serve_forever()
+        return
+    client = connect_service(args.address)
+    if client is None:
+        logging.error("No recognition service running on %s", args.address)
+        sys.exit(1)
+    with client:
+        if args.command == "status":
+            for key, value in client.ping().items():
+                print("%-12s %s" % (key, value))
+        else:
+            client.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Response cache for the attendance dashboard
+Bodies of JSON responses are kept in memory, keyed by the request, together
+with the database change marker they were computed at. An entry is served
+while its marker is current; the least recently used entries are evicted
+once the cache holds more than `max_bytes`
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+
+class ChangeMarker:
+    """Database change markers, read at most once every `ttl` seconds"""
+
+    def __init__(self, read, ttl=1.0):
+        self.read = read
+        self.ttl = ttl
+        self.value = None
+        self.read_time = 0.0
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.value is None or now - self.read_time >= self.ttl:
+                self.value = self.read()
+                self.read_time = now
+            return self.value
+
+
+def make_etag(key, validator):
+    """Unquoted entity tag of `key` at `validator`, known before the body is computed"""
+    return hashlib.sha1(repr((key, validator)).encode("utf-8")).hexdigest()[:20]
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # Larger bodies are streamed but not kept
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, key, validator):
+        """Cached body of `key` computed at `validator`, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != validator:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, validator, body):
+        if len(body) > self.max_entry_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self.entries[key] = (validator, body)
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def fill(self, key, validator, chunks):
+        """Pass the chunks of a streamed response through, and cache the body once it is complete"""
+        parts = []
+        size = 0
+        for chunk in chunks:
+            data = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+            if parts is not None:
+                size += len(data)
+                parts.append(data)
+                if size > self.max_entry_bytes:
+                    parts = None
+            yield data
+        if parts is not None:
+            self.put(key, validator, b"".join(parts))
+
+    def count_not_modified(self):
+        with self.lock:
+            self.not_modified += 1
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses + self.not_modified
+            return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "not_modified": self.not_modified,
+                    "evictions": self.evictions,
+                    # 304s are answered without the database too
+                    "hit_ratio": round((self.hits + self.not_modified) / requests, 4) if requests else 0.0}
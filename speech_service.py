@@ -0,0 +1,102 @@
+"""
+Non-blocking text-to-speech for the recognizer and the registration GUI
+pyttsx3 runs on its own thread; say() only queues the message, so frame
+processing never waits on audio. Duplicate messages are coalesced, each key
+is rate limited and messages that waited too long are dropped
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from stage_timer import NO_TIMERS
+
+
+class SpeechService:
+    def __init__(self, maxsize=4, max_age=5.0, rate_limit=0.0, timers=NO_TIMERS):
+        # At most 'maxsize' messages wait, the oldest is dropped to make room
+        self.maxsize = maxsize
+        # Messages older than 'max_age' seconds when their turn comes are not spoken
+        self.max_age = max_age
+        # Default minimum seconds between two messages with the same key
+        self.rate_limit = rate_limit
+        self.timers = timers
+
+        self.messages = collections.deque()
+        self.last_queued = {}
+        self.available = True
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.spoken = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self._run, name="SpeechService", daemon=True)
+        self.thread.start()
+
+    def say(self, text, key=None, rate_limit=None):
+        """Queue `text`, return False if it was coalesced, rate limited or speech is unavailable
+
+        Messages with the same `key` (default: the text) count as duplicates.
+        """
+        key = key if key is not None else text
+        rate_limit = self.rate_limit if rate_limit is None else rate_limit
+        now = time.time()
+        with self.cond:
+            if not self.available or self.closed:
+                return False
+            if any(message_key == key for _, message_key, _ in self.messages):
+                self.coalesced += 1
+                return False
+            if now - self.last_queued.get(key, float("-inf")) < rate_limit:
+                self.rate_limited += 1
+                return False
+            if len(self.messages) >= self.maxsize:
+                self.messages.popleft()
+                self.dropped += 1
+            self.messages.append((now, key, text))
+            self.last_queued[key] = now
+            self.cond.notify()
+        return True
+
+    def _run(self):
+        # The engine has to be created and used on the same thread
+        try:
+            # Imported here, pyttsx3 takes a while to import and is only used on this thread
+            import pyttsx3
+            engine = pyttsx3.init()
+        except Exception as e:
+            logging.warning("Text-to-speech unavailable: %s", e)
+            with self.cond:
+                self.available = False
+                self.messages.clear()
+            return
+
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.messages or self.closed)
+                if not self.messages:
+                    break
+                queued_time, _, text = self.messages.popleft()
+            if time.time() - queued_time > self.max_age:
+                self.dropped += 1
+                continue
+            try:
+                with self.timers.stage("tts"):
+                    engine.say(text)
+                    engine.runAndWait()
+                self.spoken += 1
+            except Exception as e:
+                logging.debug("Text-to-speech failed: %s", e)
+
+    def close(self, timeout=2.0):
+        """Stop after the queued messages, waiting at most `timeout` seconds"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        logging.info("Speech: %d spoken, %d coalesced, %d rate limited, %d dropped",
+                     self.spoken, self.coalesced, self.rate_limited, self.dropped)
@@ -0,0 +1,122 @@
+"""
+Per-stage latency timers for the attendance loop
+Each stage keeps its latest durations; p50 / p95 / p99 are logged, and
+optionally appended as JSON lines to a stats file, every `interval` seconds.
+Disabled timers cost one method call per stage. StartupReport logs how long a
+launch took to reach its first frame
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import threading
+import time
+
+STAGES = ("read", "detect", "track", "landmarks", "descriptor", "match", "db", "db_commit", "speech", "tts",
+          "render")
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class _Stage:
+    __slots__ = ("timers", "name", "start")
+
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timers.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimers:
+    def __init__(self, enabled=False, interval=30.0, path_stats=None, window=2000):
+        self.enabled = enabled
+        self.interval = interval
+        # JSON lines file the reports are appended to, besides the log
+        self.path_stats = path_stats
+        # Percentiles are taken over the last 'window' durations of each stage
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.last_report = time.time()
+
+    def stage(self, name):
+        """Context manager timing one run of stage `name`"""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        if not self.enabled:
+            return
+        # Stages also run on the capture, recognition, writer and speech threads
+        with self.lock:
+            self.samples[name].append(seconds)
+            self.counts[name] += 1
+
+    def summary(self):
+        """{stage: {count, p50_ms, p95_ms, p99_ms, max_ms}} of the current window"""
+        with self.lock:
+            samples = {name: sorted(durations) for name, durations in list(self.samples.items()) if durations}
+            counts = dict(self.counts)
+            self.counts.clear()
+        order = {name: i for i, name in enumerate(STAGES)}
+        summary = {}
+        for name in sorted(samples, key=lambda name: order.get(name, len(order))):
+            durations = samples[name]
+            summary[name] = {"count": counts.get(name, 0),
+                             "p50_ms": round(durations[int(len(durations) * 0.50)] * 1000, 3),
+                             "p95_ms": round(durations[int(len(durations) * 0.95)] * 1000, 3),
+                             "p99_ms": round(durations[int(len(durations) * 0.99)] * 1000, 3),
+                             "max_ms": round(durations[-1] * 1000, 3)}
+        return summary
+
+    def report(self, force=False):
+        if not self.enabled:
+            return
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        summary = self.summary()
+        for name, stats in summary.items():
+            logging.info("Stage %-10s %6d runs  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  max %8.2f ms",
+                         name, stats["count"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"])
+        if self.path_stats:
+            try:
+                with open(self.path_stats, "a") as f:
+                    f.write(json.dumps({"time": round(now, 3), "stages": summary}) + "\n")
+            except OSError as e:
+                logging.warning("Could not write stage timers to '%s': %s", self.path_stats, e)
+
+
+# Shared disabled instance for callers that are not instrumented
+NO_TIMERS = StageTimers(enabled=False)
+
+
+class StartupReport:
+    """Milestones of a launch, in ms since `start`, logged once when the first frame is done"""
+
+    def __init__(self, start):
+        self.start = start
+        self.milestones = []
+        self.done = False
+
+    def mark(self, name, when=None):
+        # Milestones are also marked from the model loader thread, list.append is atomic
+        self.milestones.append((name, (when if when is not None else time.perf_counter()) - self.start))
+
+    def frame_done(self):
+        if self.done:
+            return
+        self.done = True
+        self.mark("first frame")
+        logging.info("Startup: %s", ", ".join("%s %.0f ms" % (name, seconds * 1000)
+                                              for name, seconds in sorted(self.milestones, key=lambda m: m[1])))
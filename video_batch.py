@@ -0,0 +1,141 @@
+"""
+Offline attendance from recorded videos for Face Recognition Attendance System
+Videos are processed as fast as the CPU allows, without display, on a pool of
+processes; attendance is stamped with the time in the video, so footage from
+a camera PC outage can be back-filled or re-run after a gallery fix
+"""
+
+import argparse
+import datetime
+import logging
+import multiprocessing
+import os
+import time
+
+import cv2
+
+from attendance_taker import load_known_faces, match_tracks
+from attendance_writer import AttendanceWriter
+from face_detection import ScaledDetector
+from face_index import load_or_build_index
+from face_tracker import FaceTracker
+
+
+def video_start_time(path_video, stream):
+    """Wall-clock time of the first frame: the file is last written when the recording ends"""
+    fps = stream.get(cv2.CAP_PROP_FPS) or 0
+    frames_cnt = stream.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+    duration = frames_cnt / fps if fps > 0 else 0
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path_video) - duration)
+
+
+def process_video(job):
+    """Attendance events (when, name, department, position) of one video, the first sighting per person and day
+
+    `job` is (path_video, stride, start, detect_scale); only every `stride`-th frame
+    is decoded, `start` is the time of the first frame or None to guess it.
+    """
+    path_video, stride, start, detect_scale = job
+    known_faces = load_known_faces()
+    if known_faces is None:
+        raise RuntimeError("No gallery to recognize faces with")
+    gallery, path_features_known = known_faces
+    load_or_build_index(gallery, path_features_known)
+
+    stream = cv2.VideoCapture(path_video)
+    if not stream.isOpened():
+        raise OSError("Could not open video '%s'" % path_video)
+    fps = stream.get(cv2.CAP_PROP_FPS) or 25.0
+    start = start or video_start_time(path_video, stream)
+    face_detector = ScaledDetector(scale=detect_scale)
+    # Faces move further between two processed frames when frames are skipped
+    face_tracker = FaceTracker(max_missed=max(2, 5 // stride))
+
+    first_seen = {}
+    frame_index = -1
+    processed_cnt = 0
+    start_time = time.time()
+    try:
+        while True:
+            frame_index += 1
+            if frame_index % stride:
+                # Skipped frames are grabbed but not decoded
+                if not stream.grab():
+                    break
+                continue
+            flag, img_rd = stream.read()
+            if not flag:
+                break
+            processed_cnt += 1
+            faces = face_detector(img_rd)
+            tracks = face_tracker.update(faces)
+            tracks_to_recognize = [track for track in tracks if track.needs_recognition(processed_cnt)]
+            if not tracks_to_recognize:
+                continue
+            match_tracks(gallery, img_rd, tracks_to_recognize, processed_cnt, 10, 320)
+            when = start + datetime.timedelta(seconds=frame_index / fps)
+            for track in tracks_to_recognize:
+                # Recordings may run past midnight: first sighting per person and day
+                if track.person_id >= 0 and (track.name, when.date()) not in first_seen:
+                    first_seen[track.name, when.date()] = (when,) + gallery.person(track.person_id)
+    finally:
+        stream.release()
+
+    seconds = time.time() - start_time
+    logging.info("%s: %d frames, %d processed in %.1f s (%.1fx real time), %d people",
+                 path_video, frame_index, processed_cnt, seconds,
+                 frame_index / fps / seconds if seconds else 0.0, len(first_seen))
+    return path_video, sorted(first_seen.values())
+
+
+def init_worker():
+    logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Take attendance from recorded videos")
+    parser.add_argument("videos", nargs="+", help="Video files to process")
+    parser.add_argument("--stride", type=int, default=5, help="Process every n-th frame")
+    parser.add_argument("--start", default=None,
+                        help="Time of the first frame, 'YYYY-MM-DD HH:MM:SS' (one video only); "
+                             "by default the modification time of the file minus its duration")
+    parser.add_argument("--workers", type=int, default=1, help="Videos processed in parallel, 0 for one per CPU core")
+    parser.add_argument("--detect-scale", type=float, default=1.0,
+                        help="Scale of the frame the face detector runs on, e.g. 0.5")
+    parser.add_argument("--dry-run", action="store_true", help="Print the attendance events, do not write them")
+    args = parser.parse_args()
+    if args.start and len(args.videos) > 1:
+        parser.error("--start can only be given for one video")
+    start = datetime.datetime.strptime(args.start, '%Y-%m-%d %H:%M:%S') if args.start else None
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+
+    jobs = [(path_video, max(1, args.stride), start, args.detect_scale) for path_video in args.videos]
+    events = []
+    start_time = time.time()
+    if workers <= 1 or len(jobs) <= 1:
+        for path_video, video_events in map(process_video, jobs):
+            events += video_events
+    else:
+        with multiprocessing.Pool(min(workers, len(jobs)), initializer=init_worker) as pool:
+            for path_video, video_events in pool.imap_unordered(process_video, jobs):
+                events += video_events
+    logging.info("%d videos processed in %.1f s", len(jobs), time.time() - start_time)
+
+    # In time order, so the earliest sighting of a day is the one recorded
+    events.sort()
+    if args.dry_run:
+        for when, name, department, position in events:
+            print(when.strftime('%Y-%m-%d %H:%M:%S'), name, department, position, sep="\t")
+        return
+    attendance_writer = AttendanceWriter("attendance.db")
+    for when, name, department, position in events:
+        newly_marked, date, time_str = attendance_writer.mark(name, department, position, when=when)
+        if newly_marked:
+            print(f"{name} ({department}, {position}) marked as present for {date} at {time_str}")
+    attendance_writer.close()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()